@@ -0,0 +1,86 @@
+import sys
+import time
+import numpy as np
+import pandas as pd
+from unittest.mock import MagicMock
+
+# Mock streamlit and gsheets before importing mod
+sys.modules["streamlit"] = MagicMock()
+sys.modules["streamlit_gsheets"] = MagicMock()
+sys.modules["mod.O_connect_to_gsheet"] = MagicMock()
+
+# Ensure 'mod' can be imported. Assuming running from 'code' directory.
+sys.path.append(".")
+from mod import C_consume
+
+N_MEMBERS = 2000
+N_EVENTS = 100000
+GROUP_SIZES = [1, 5, 20, 50]
+REPEAT = 5
+
+
+def make_test_data():
+    """產生測試用的會員、教練與交易紀錄"""
+    rng = np.random.default_rng(0)
+    member_ids = [str(1000 + i) for i in range(N_MEMBERS)]
+
+    df_member = pd.DataFrame({
+        "會員編號": member_ids,
+        "會員姓名": [f"會員{i}" for i in range(N_MEMBERS)],
+        "生日": "1990-01-01",
+        "電話": "0912345678",
+    })
+    df_coach = pd.DataFrame({"姓名": ["教練"], "教練編號": ["100"], "會員編號": ["1"]})
+
+    # 每位會員先購買一次，其餘為隨機上課紀錄
+    df_buy = pd.DataFrame({
+        "會員編號": member_ids,
+        "方案": "A",
+        "堂數": 500,
+        "方案總金額": 500 * 1200,
+        "交易日期": "2024-01-01",
+    })
+    n_consume = N_EVENTS - N_MEMBERS
+    df_consume = pd.DataFrame({
+        "會員編號": rng.choice(member_ids, size=n_consume),
+        "方案": rng.choice(["A", "B", "C"], size=n_consume),
+        "堂數": -1,
+        "方案總金額": -1200,
+        "交易日期": "2024-06-01",
+    })
+    df_event = pd.concat([df_buy, df_consume], ignore_index=True)
+
+    return member_ids, df_member, df_coach, df_event
+
+
+def bench_validate_consume():
+    member_ids, df_member, df_coach, df_event = make_test_data()
+    print(f"交易紀錄 {len(df_event)} 筆，會員 {len(df_member)} 位")
+
+    results = {}
+    for size in GROUP_SIZES:
+        group = member_ids[:size]
+        start = time.perf_counter()
+        for _ in range(REPEAT):
+            success, msg, data = C_consume.validate_consume_record(
+                group, "A", "教練", df_event=df_event, df_member=df_member, df_coach=df_coach)
+        elapsed = (time.perf_counter() - start) / REPEAT
+
+        assert success, msg
+        assert len(data["batch_list"]) == size
+        results[size] = elapsed
+        print(f"團課人數 {size:>3}：{elapsed * 1000:8.2f} ms")
+
+    # 批次驗證只彙總一次，耗時不應隨人數等比增加
+    ratio = results[GROUP_SIZES[-1]] / results[GROUP_SIZES[0]]
+    print(f"{GROUP_SIZES[-1]} 人 / {GROUP_SIZES[0]} 人 耗時比：{ratio:.2f}")
+    assert ratio < 3, f"團課驗證耗時隨人數增加過多: {ratio:.2f}"
+
+
+if __name__ == "__main__":
+    try:
+        bench_validate_consume()
+        print("\nBENCHMARK PASSED")
+    except Exception as e:
+        print(f"\nBENCHMARK FAILED: {e}")
+        exit(1)
@@ -1,8 +1,11 @@
 import re
 from datetime import datetime
 import pandas as pd
+from mod import O_cache as cache
 from mod import O_general as gr
-from mod.O_config import MEMBER_SHEET, COACH
+from mod import O_transaction as txn
+from mod.O_config import MEMBER_SHEET
+from mod.O_lookup import LookupSnapshot
 
 # def validate_email(email: str) -> bool:
 #     """驗證email格式"""
@@ -39,34 +42,28 @@ def validate_birthday(birthday: str) -> str | None:
 #     return coach_id, coach_str
 
 
-def check_duplicates(df_member: pd.DataFrame, name: str, birthday: str, member_id: str = None) -> list[str]:
+def check_duplicates(df_member: pd.DataFrame, name: str, birthday: str, member_id: str = None, lookup: LookupSnapshot = None) -> list[str]:
     """檢查是否有重複會員，回傳重複的會員資訊列表，若無重複回傳空列表"""
-    if df_member.empty:
-        return []
+    if lookup is None:
+        if df_member.empty:
+            return []
+        lookup = LookupSnapshot(df_member=df_member)
 
-    mask_name = (df_member["會員姓名"] == name)
-    mask_birthday = (df_member["生日"] == birthday)
-
-    # 只要姓名和Email同時符合就算重複 (根據原本邏輯 check_and_remove_duplicates)
-    # 原本邏輯是 merge inner join on name AND birthday
-
-    duplicates = df_member[mask_name & mask_birthday]
+    # 只要姓名和生日同時符合就算重複 (根據原本邏輯 check_and_remove_duplicates)
+    duplicates = lookup.find_members(name, birthday)
 
     result = []
-    if not duplicates.empty:
-        for _, row in duplicates.iterrows():
-            result.append(f"{row['會員姓名']} | {row['電話']}")
+    for row in duplicates:
+        result.append(f"{row['會員姓名']} | {row['電話']}")
 
     # 檢查 id 是否重複
-    if member_id:
-        mask_id = (df_member["會員編號"] == member_id)
-        if not df_member[mask_id].empty:
-            result.append(f"會員編號重複 {member_id}")
+    if member_id and lookup.get_members(member_id):
+        result.append(f"會員編號重複 {member_id}")
 
     return result
 
 
-def validate_add_member(member_id: str, name: str, birthday: str, phone: str, coach: str, remarks: str = "", df_member: pd.DataFrame = None, df_coach: pd.DataFrame = None) -> tuple[bool, str, dict]:
+def validate_add_member(member_id: str, name: str, birthday: str, phone: str, coach: str, remarks: str = "", df_member: pd.DataFrame = None, df_coach: pd.DataFrame = None, lookup: LookupSnapshot = None) -> tuple[bool, str, dict]:
     """
     驗證新增會員資料
     Returns:
@@ -87,17 +84,17 @@ def validate_add_member(member_id: str, name: str, birthday: str, phone: str, co
         return False, "電話格式不正確", {}
 
     try:
-        # 2. 讀取現有會員資料
-        if df_member is None:
-            df_member = gr.GET_DF_FROM_DB(sheet=MEMBER_SHEET)
+        # 2. 建立查詢索引（未傳入的分頁會在使用時讀取）
+        if lookup is None:
+            lookup = LookupSnapshot(df_member=df_member, df_coach=df_coach)
         try:
-            coach_id, coach_str = gr.get_coach_id(coach, df_coach=df_coach)
+            coach_id, coach_str = gr.get_coach_id(coach, lookup=lookup)
             member_id_formatted = str(coach_str).replace(".0", "") + str(member_id)
         except Exception as e:
             return False, f"取得教練資料失敗: {str(e)}", {}
 
         # 3. 檢查重複
-        duplicates = check_duplicates(df_member, name, formatted_birthday, member_id_formatted)
+        duplicates = check_duplicates(df_member, name, formatted_birthday, member_id_formatted, lookup=lookup)
         if duplicates:
             msg = "無法新增會員資料：\n" + "\n".join(duplicates)
             return False, msg, {}
@@ -124,18 +121,22 @@ def validate_add_member(member_id: str, name: str, birthday: str, phone: str, co
         return False, f"系統錯誤：{str(e)}", {}
 
 
+def _append_member(df_new: pd.DataFrame, df_member: pd.DataFrame = None) -> tuple[bool, str]:
+    success, msg = gr.APPEND_TO_SHEET(df=df_new, sheet=MEMBER_SHEET)
+    if success:
+        # 併入快取中最新的會員表：呼叫端的會員表可能已是舊版本（例如其他使用者剛新增會員），不需重新讀取整張表
+        cache.patch_append(MEMBER_SHEET, txn.get_current(MEMBER_SHEET, df_member), df_new)
+    return success, msg
+
+
 def execute_add_member(data: dict, df_member: pd.DataFrame = None) -> tuple[bool, str]:
     """
     執行新增會員資料
     """
     try:
-        if df_member is None:
-            df_member = gr.GET_DF_FROM_DB(sheet=MEMBER_SHEET)
         df_new = pd.DataFrame([data])
-        
-        # 5. 合併並存檔
-        df_member = pd.concat([df_member, df_new], ignore_index=True)
-        success, msg = gr.SAVE_TO_SHEET(df=df_member, sheet=MEMBER_SHEET)
-        return success, msg
+
+        # 5. 只附加新會員資料列，不重寫整張會員表；由寫入協調器與其他寫入依序執行
+        return txn.get_coordinator().run(_append_member, df_new, df_member)
     except Exception as e:
         return False, f"儲存失敗：{str(e)}"
@@ -1,9 +1,9 @@
 import re
 from datetime import datetime
 import pandas as pd
-from mod import D_main_table as mt
 from mod import O_general as gr
-from mod.O_config import EVENT_SHEET, MEMBER_SHEET, MENU
+from mod import O_transaction as txn
+from mod.O_lookup import LookupSnapshot
 
 
 def validate_account_id(payment: str, account_id: str) -> bool:
@@ -13,33 +13,28 @@ def validate_account_id(payment: str, account_id: str) -> bool:
     return True
 
 
-def get_price_and_total(plan: str, count: int, df_menu: pd.DataFrame = None) -> tuple[float, int]:
+def get_price_and_total(plan: str, count: int, df_menu: pd.DataFrame = None, lookup: LookupSnapshot = None) -> tuple[float, int]:
     """取得單價與總價"""
 
-    if df_menu is None:
-        df_menu = gr.GET_DF_FROM_DB(sheet=MENU)
-    df_menu["price"] = df_menu["price"].astype(float)
+    if lookup is None:
+        lookup = LookupSnapshot(df_menu=df_menu)
 
     # 嘗試直接對應 Plan 與 Count
-    mask1 = (df_menu["name"] == plan)
-    mask2 = (df_menu["count"] == count)
-    result = df_menu[mask1 & mask2]
+    price = lookup.get_price(plan, count)
 
     # Fallback logic for 17 classes (Buy 16 Get 1 Free)
-    if result.empty and count == 17:
-        mask2_fallback = (df_menu["count"] == 16)
-        result = df_menu[mask1 & mask2_fallback]
+    if price is None and count == 17:
+        price = lookup.get_price(plan, 16)
 
-    if result.empty:
+    if price is None:
         raise ValueError(f"找不到對應的價格設定: 方案{plan}, 堂數{count}")
 
-    price = result["price"].iloc[0]
     total = int(price * count)
 
     return price, total
 
 
-def validate_purchase_record(member_id: str, plan: str, count_selection: str, payment: str, coach: str, account_id: str = "無", remarks: str = "", df_member: pd.DataFrame = None, df_menu: pd.DataFrame = None, df_coach: pd.DataFrame = None) -> tuple[bool, str, dict]:
+def validate_purchase_record(member_id: str, plan: str, count_selection: str, payment: str, coach: str, account_id: str = "無", remarks: str = "", df_member: pd.DataFrame = None, df_menu: pd.DataFrame = None, df_coach: pd.DataFrame = None, lookup: LookupSnapshot = None) -> tuple[bool, str, dict]:
     """
     驗證購買紀錄
     Returns:
@@ -47,13 +42,13 @@ def validate_purchase_record(member_id: str, plan: str, count_selection: str, pa
     """
     try:
         # 1. 驗證會員是否存在
-        if df_member is None:
-            df_member = gr.GET_DF_FROM_DB(sheet=MEMBER_SHEET)
-        mask_member = (df_member["會員編號"] == member_id)
-        if df_member[mask_member].empty:
+        if lookup is None:
+            lookup = LookupSnapshot(df_member=df_member, df_menu=df_menu, df_coach=df_coach)
+        members = lookup.get_members(member_id)
+        if not members:
             return False, "查無此會員資料 (姓名與Email不符或不存在)", {}
 
-        if len(df_member[mask_member]) > 1:
+        if len(members) > 1:
             return False, "系統中存在重複會員資料，請先清理重複會員資料", {}
 
         # 2. 轉換堂數邏輯
@@ -79,15 +74,15 @@ def validate_purchase_record(member_id: str, plan: str, count_selection: str, pa
 
         # 4. 計算價格
         try:
-            price, total = get_price_and_total(plan, final_count, df_menu=df_menu)
+            price, total = get_price_and_total(plan, final_count, lookup=lookup)
         except ValueError as e:
             return False, str(e), {}
 
         # 5. 準備資料
         today = datetime.now().date().strftime("%Y-%m-%d")
         now_time = datetime.now().time().strftime("%H:%M:%S")
-        coach_id, _ = gr.get_coach_id(coach, df_coach=df_coach)
-        member_name = gr.get_member_name(member_id, df_member=df_member)
+        coach_id, _ = gr.get_coach_id(coach, lookup=lookup)
+        member_name = members[0]["會員姓名"]
 
         purchase_info = {
             "會員編號": member_id,
@@ -115,22 +110,13 @@ def execute_purchase_record(data: dict, df_event: pd.DataFrame = None, df_member
     執行新增購買紀錄
     """
     try:
-        # 6. 存檔
-        if df_event is None:
-            df_event = gr.GET_DF_FROM_DB(sheet=EVENT_SHEET)
+        # 6. 存檔（只附加新資料列）
+        # 交易紀錄與主表由寫入協調器一起更新；期間有其他使用者新增交易時，購買紀錄不受影響，重新讀取後直接再寫入
         df_new = pd.DataFrame([data])
-        df_event = pd.concat([df_event, df_new], ignore_index=True)
-
-        success, msg = gr.SAVE_TO_SHEET(df=df_event, sheet=EVENT_SHEET)
+        success, msg, _ = txn.get_coordinator().submit_events(
+            df_new=df_new, df_event=df_event, df_member=df_member)
 
         if success:
-            # 7. 更新主表
-            try:
-                # Pass updated df_event and (cached or loaded) df_member to update function
-                mt.D_update_main_data(df_event=df_event, df_member=df_member)
-            except Exception as e:
-                return True, f"購買紀錄儲存成功，但主表更新失敗: {e}"
-
             return True, "新增課程購買紀錄成功！"
         else:
             return False, msg
@@ -2,23 +2,83 @@ from datetime import datetime
 import pandas as pd
 from mod import D_main_table as mt
 from mod import O_general as gr
+from mod import O_transaction as txn
 from mod.O_config import EVENT_SHEET
+from mod.O_lookup import LookupSnapshot
 
 
-def get_member_stock(member_id: str, plan: str, df_event: pd.DataFrame = None) -> pd.DataFrame:
-    """取得特定會員特定方案的庫存狀況"""
+def get_batch_stock(member_id_list: list[str], plan: str, df_event: pd.DataFrame = None) -> pd.DataFrame:
+    """
+    一次取得多位會員在同一方案的庫存狀況
+    先篩選出該方案與選取會員的交易紀錄再彙總，只需掃描交易紀錄一次
+    Returns:
+        依 member_id_list 順序排列的庫存表，查無紀錄的會員剩餘堂數為 NaN
+    """
     if df_event is None:
         df_event = gr.GET_DF_FROM_DB(sheet=EVENT_SHEET)
-    # 使用 D_main_table 的邏輯計算剩餘堂數
-    df_sum = mt.get_sum_table(df_event)
 
-    mask1 = (df_sum["會員編號"] == member_id)
-    mask2 = (df_sum["方案"] == plan)
+    mask1 = (df_event["方案"] == plan)
+    mask2 = df_event["會員編號"].isin(member_id_list)
 
-    return df_sum[mask1 & mask2]
+    # 使用 D_main_table 的邏輯計算剩餘堂數
+    df_sum = mt.get_sum_table(df_event[mask1 & mask2])
+
+    df_selected = pd.DataFrame({"會員編號": member_id_list})
+    return df_selected.merge(df_sum, how="left", on="會員編號")
 
 
-def validate_consume_record(member_id_list: list[str], plan: str, coach: str, remarks: str = "", df_event: pd.DataFrame = None, df_member: pd.DataFrame = None, df_coach: pd.DataFrame = None) -> tuple[bool, str, dict]:
+def check_batch_consume(member_id_list: list[str], plan: str, coach_id: str, remarks: str = "", df_event: pd.DataFrame = None, df_member: pd.DataFrame = None, lookup: LookupSnapshot = None) -> tuple[list[str], list[dict]]:
+    """
+    批次檢查會員庫存並產生扣堂資料
+    Returns:
+        (error_messages: 每位會員的錯誤訊息, batch_data: 可扣堂的資料列)
+    """
+    if lookup is None:
+        lookup = LookupSnapshot(df_member=df_member)
+
+    df_stock = get_batch_stock(member_id_list, plan, df_event=df_event)
+
+    # 以查詢索引對應所選會員的姓名
+    members = [lookup.get_member(member_id) for member_id in df_stock["會員編號"]]
+    df_stock["會員姓名"] = [member["會員姓名"] if member else "未知會員" for member in members]
+
+    no_record = df_stock["剩餘堂數"].isna()
+    no_stock = ~no_record & (df_stock["剩餘堂數"] <= 0)
+
+    error_messages = []
+    for member_id, member_name, remaining_count, is_no_record, is_no_stock in zip(
+            df_stock["會員編號"], df_stock["會員姓名"], df_stock["剩餘堂數"], no_record, no_stock):
+        if is_no_record:
+            error_messages.append(f"{member_id} ({member_name}): 查無該方案購買紀錄")
+        elif is_no_stock:
+            error_messages.append(f"{member_id} ({member_name}): 剩餘堂數不足 ({remaining_count:g})")
+
+    # 準備扣堂資料
+    today = datetime.now().date().strftime("%Y-%m-%d")
+    now_time = datetime.now().time().strftime("%H:%M:%S")
+
+    df_ok = df_stock[~no_record & ~no_stock]
+    avg_price = df_ok["平均單堂金額"].astype(float)
+    df_batch = pd.DataFrame({
+        "會員編號": df_ok["會員編號"],
+        "會員姓名": df_ok["會員姓名"],
+        "方案": plan,
+        "堂數": -1,
+        "單堂金額": avg_price,
+        "方案總金額": (avg_price * -1),
+        "教練": coach_id,
+        "付款方式": "上課",
+        "匯款末五碼": "無",
+        "交易日期": today,
+        "交易時間": now_time,
+        "備註": remarks
+    })
+    batch_data = df_batch.to_dict("records")
+
+    return error_messages, batch_data
+
+
+def validate_consume_record(member_id_list: list[str], plan: str, coach: str, remarks: str = "", df_event: pd.DataFrame = None, df_member: pd.DataFrame = None, df_coach: pd.DataFrame = None, lookup: LookupSnapshot = None) -> tuple[bool, str, dict]:
     """
     驗證上課(扣堂)紀錄 - 支援批次處理
     Args:
@@ -32,52 +92,15 @@ def validate_consume_record(member_id_list: list[str], plan: str, coach: str, re
         if not member_id_list:
             return False, "請至少選擇一位會員", {}
 
-        batch_data = []
-        error_messages = []
-
-        batch_data = []
-        error_messages = []
+        if lookup is None:
+            lookup = LookupSnapshot(df_member=df_member, df_coach=df_coach)
 
         # 取得教練ID一次即可
-        coach_id, _ = gr.get_coach_id(coach, df_coach=df_coach)
-        today = datetime.now().date().strftime("%Y-%m-%d")
-        now_time = datetime.now().time().strftime("%H:%M:%S")
-
-        for member_id in member_id_list:
-            # 1. 檢查是否有庫存
-            df_result = get_member_stock(member_id, plan, df_event=df_event)
-            try:
-                member_name = gr.get_member_name(member_id, df_member=df_member)
-            except Exception:
-                member_name = "未知會員"
-
-            if df_result.empty:
-                error_messages.append(f"{member_id} ({member_name}): 查無該方案購買紀錄")
-                continue
-
-            remaining_count = df_result["剩餘堂數"].iloc[0]
-            if remaining_count <= 0:
-                error_messages.append(f"{member_id} ({member_name}): 剩餘堂數不足 ({remaining_count})")
-                continue
-
-            # 2. 準備扣堂資料
-            avg_price = float(df_result["平均單堂金額"].iloc[0])
-            
-            consume_info = {
-                "會員編號": member_id,
-                "會員姓名": member_name,
-                "方案": plan,
-                "堂數": -1,
-                "單堂金額": avg_price,
-                "方案總金額": (avg_price * -1),
-                "教練": coach_id,
-                "付款方式": "上課",
-                "匯款末五碼": "無",
-                "交易日期": today,
-                "交易時間": now_time,
-                "備註": remarks
-            }
-            batch_data.append(consume_info)
+        coach_id, _ = gr.get_coach_id(coach, lookup=lookup)
+
+        # 1. 一次檢查所有會員庫存，並產生扣堂資料
+        error_messages, batch_data = check_batch_consume(
+            member_id_list, plan, coach_id, remarks, df_event=df_event, lookup=lookup)
 
         if error_messages:
             full_msg = "資料存取失敗：\n" + "\n".join(error_messages)
@@ -89,6 +112,17 @@ def validate_consume_record(member_id_list: list[str], plan: str, coach: str, re
         return False, f"系統錯誤：{str(e)}", {}
 
 
+def recheck_consume(df_records: pd.DataFrame, df_event: pd.DataFrame, df_member: pd.DataFrame = None) -> pd.DataFrame:
+    """以最新的交易紀錄重新檢查剩餘堂數並重新產生扣堂資料，有會員已不足時拋出 InputError"""
+    first = df_records.iloc[0]
+    error_messages, batch_data = check_batch_consume(
+        df_records["會員編號"].tolist(), first["方案"], first["教練"], first["備註"],
+        df_event=df_event, df_member=df_member)
+    if error_messages:
+        raise gr.InputError("\n".join(error_messages))
+    return pd.DataFrame(batch_data)
+
+
 def execute_consume_record(data: dict, df_event: pd.DataFrame = None, df_member: pd.DataFrame = None) -> tuple[bool, str]:
     """
     執行新增上課(扣堂)紀錄 - 支援批次
@@ -103,21 +137,15 @@ def execute_consume_record(data: dict, df_event: pd.DataFrame = None, df_member:
         else:
             records = [data]
 
-        if df_event is None:
-            df_event = gr.GET_DF_FROM_DB(sheet=EVENT_SHEET)
-        df_new = pd.DataFrame(records)
-        df_event = pd.concat([df_event, df_new], ignore_index=True)
-
-        success, msg = gr.SAVE_TO_SHEET(df=df_event, sheet=EVENT_SHEET)
+        # 只附加本次的上課紀錄，不重寫整張事件表
+        # 寫入前依最新的交易紀錄（含同時送出的其他交易）重新檢查剩餘堂數
+        df_records = pd.DataFrame(records)
+        success, msg, df_new = txn.get_coordinator().submit_events(
+            df_new=df_records, df_event=df_event, df_member=df_member,
+            rebuild=lambda df_latest: recheck_consume(df_records, df_latest, df_member=df_member))
 
         if success:
-            # 4. 更新主表
-            try:
-                mt.D_update_main_data(df_event=df_event, df_member=df_member)
-            except Exception as e:
-                return True, f"上課紀錄儲存成功，但主表更新失敗: {e}"
-
-            count = len(records)
+            count = len(df_new)
             return True, f"成功新增 {count} 筆上課紀錄！"
         else:
             return False, msg
@@ -1,31 +1,218 @@
+import threading
+import numpy as np
 import pandas as pd
+from mod import O_checkpoint as ckpt
 from mod import O_general as gr
-from mod.O_config import EVENT_SHEET, MAIN_SHEET, MEMBER_SHEET
+from mod import O_storage as storage
+from mod.O_config import CHECKPOINT_INTERVAL, EVENT_SHEET, MAIN_SHEET, MEMBER_SHEET
+
+SUM_COLS = ['會員編號', '方案', '剩餘堂數', '平均單堂金額', '剩餘預收款項', '最近交易日期']
+MEMBER_COLS = ['會員編號', '會員姓名', '生日', '電話']
+# 覆寫主表的列時用來確認該列未被其他使用者更新的欄位
+MAIN_VERSION_COLS = ['會員編號', '方案', '剩餘堂數', '剩餘預收款項']
+
+
+def get_avg_price(remaining_total, remaining_count):
+    """計算平均單堂金額，剩餘堂數為0時回傳0（避免除以零）"""
+    remaining_total = np.asarray(remaining_total, dtype=float)
+    remaining_count = np.asarray(remaining_count, dtype=float)
+    safe_count = np.where(remaining_count != 0, remaining_count, 1)
+    return np.where(remaining_count != 0, remaining_total / safe_count, 0).round(2)
 
 
 def get_sum_table(df_event: pd.DataFrame) -> pd.DataFrame:
-    df_sum = (df_event.groupby(["會員編號", "方案"]).agg(
+    # 交易紀錄的金額以 float32 保存，彙總前轉回 float64 並取到小數第二位，避免累加誤差
+    amount = df_event["方案總金額"].astype("float64").round(2)
+    df_sum = (df_event[["會員編號", "方案", "堂數", "交易日期"]].assign(方案總金額=amount)
+              .groupby(["會員編號", "方案"], observed=True).agg(
         剩餘堂數=("堂數", "sum"),
         剩餘預收款項=("方案總金額", "sum"),
         最近交易日期=("交易日期", "last")
     ).reset_index()
     )
 
+    # 交易日期含交易時間，主表只保留日期
+    if pd.api.types.is_datetime64_any_dtype(df_sum["最近交易日期"]):
+        df_sum["最近交易日期"] = df_sum["最近交易日期"].dt.normalize()
+
     # Avoid division by zero
-    df_sum["平均單堂金額"] = df_sum.apply(
-        lambda x: (x["剩餘預收款項"] / x["剩餘堂數"]) if x["剩餘堂數"] != 0 else 0, axis=1
-    ).round(2)
-    
-    new_cols = ['會員編號', '方案', '剩餘堂數', '平均單堂金額', '剩餘預收款項', '最近交易日期']
-    df_sum = df_sum[new_cols]
+    df_sum["平均單堂金額"] = get_avg_price(df_sum["剩餘預收款項"], df_sum["剩餘堂數"])
+
+    df_sum = df_sum[SUM_COLS]
 
     return df_sum
 
 
-def get_df_main(df_event: pd.DataFrame, df_member: pd.DataFrame) -> pd.DataFrame:
-    df_sum = get_sum_table(df_event=df_event)
+class BalanceEngine:
+    """
+    主表的增量狀態，每個主表版本共用一個（保存在 O_cache）
+    以 (會員編號, 方案) 為 key 記錄各列在主表中的位置，新交易只讀取與覆寫有變動的列，
+    不需重建索引或複製整張主表；完整的主表延後到第一次讀取時才產生（to_frame）
+    """
+
+    def __init__(self, df_main: pd.DataFrame):
+        """由主表建立（每個主表版本只建立一次），成本與主表列數成正比；df_main 的 index 為資料列位置"""
+        self._lock = threading.Lock()
+        self._df_main = df_main
+        self._positions = dict(zip(zip(df_main.get("會員編號", []), df_main.get("方案", [])), df_main.index))
+        # 尚未併入 _df_main 的變動 {資料列位置: 整列內容}，包含被覆寫的既有列與新增的列
+        self._changes = {}
+        self.columns = list(df_main.columns) if not df_main.empty else MEMBER_COLS + SUM_COLS[1:]
+        self.row_count = len(df_main)
+
+    def _row(self, position: int) -> dict:
+        """資料列目前的內容（含尚未併入主表的變動）"""
+        row = self._changes.get(position)
+        return row if row is not None else self._df_main.loc[position].to_dict()
+
+    def get_rows(self, positions: list[int], columns: list[str] = None) -> pd.DataFrame:
+        """取得指定資料列目前的內容，index 為資料列位置"""
+        with self._lock:
+            rows = [self._row(position) for position in positions]
+        return pd.DataFrame(rows, index=list(positions), columns=columns or self.columns)
+
+    def tail(self) -> tuple[int, object]:
+        """資料列數與最後一列第一欄的值，不需產生完整主表"""
+        with self._lock:
+            if self.row_count == 0:
+                return 0, None
+            return self.row_count, self._row(self.row_count - 1)[self.columns[0]]
+
+    def changes(self, df_new: pd.DataFrame, df_member: pd.DataFrame = None) -> tuple[pd.DataFrame, pd.DataFrame]:
+        """
+        計算新事件對主表的變動，只處理有變動的 (會員編號, 方案)；不修改引擎，寫入成功後再以 commit 套用
+        Returns:
+            (df_updated: 覆寫後的既有列, df_added: 附加在最後的新列)，index 皆為資料列位置
+        """
+        df_delta = get_sum_table(df_new)
+        is_new = [key not in self._positions for key in zip(df_delta["會員編號"], df_delta["方案"])]
+        df_existing = df_delta[[not x for x in is_new]]
 
-    df_member = df_member[['會員編號', '會員姓名', '生日', '電話']]
+        # 既有的 (會員, 方案) 以差額累加結餘
+        updated = {}
+        with self._lock:
+            for member_id, plan, count, total, last_date in zip(
+                    df_existing["會員編號"], df_existing["方案"], df_existing["剩餘堂數"],
+                    df_existing["剩餘預收款項"], df_existing["最近交易日期"]):
+                position = self._positions[(member_id, plan)]
+                row = dict(self._row(position))
+                row["剩餘堂數"] += count
+                row["剩餘預收款項"] += total
+                row["最近交易日期"] = last_date
+                row["平均單堂金額"] = float(get_avg_price(row["剩餘預收款項"], row["剩餘堂數"]))
+                updated[position] = row
+            row_count = self.row_count
+        df_updated = pd.DataFrame(list(updated.values()), index=list(updated), columns=self.columns)
+
+        # 新的 (會員, 方案) 需補上會員基本資料後附加在最後
+        df_added = df_delta[is_new]
+        if not df_added.empty:
+            if df_member is None:
+                df_member = gr.GET_DF_FROM_DB(sheet=MEMBER_SHEET)
+            df_added = df_member[MEMBER_COLS].merge(df_added, how="inner", on=['會員編號'])
+        df_added = df_added.reindex(columns=self.columns)
+        df_added.index = range(row_count, row_count + len(df_added))
+
+        return df_updated, df_added
+
+    def commit(self, df_updated: pd.DataFrame, df_added: pd.DataFrame):
+        """寫入成功後套用 changes 計算的變動"""
+        with self._lock:
+            for position, row in zip(df_updated.index, df_updated.to_dict("records")):
+                self._changes[position] = row
+            for position, row in zip(df_added.index, df_added.to_dict("records")):
+                self._changes[position] = row
+                self._positions[(row["會員編號"], row["方案"])] = position
+            self.row_count += len(df_added)
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        產生目前的完整主表（讀取時才呼叫），併入變動後之後的讀取共用同一份資料
+        取得的 DataFrame 不可直接修改
+        """
+        with self._lock:
+            if not self._changes:
+                return self._df_main
+
+            base_rows = len(self._df_main)
+            df_changes = pd.DataFrame(list(self._changes.values()), index=list(self._changes),
+                                      columns=self.columns).sort_index()
+            df_existing = df_changes[df_changes.index < base_rows]
+            df_added = df_changes[df_changes.index >= base_rows]
+
+            df_main = self._df_main.copy()
+            if not df_existing.empty:
+                for col in SUM_COLS[2:]:
+                    # combine_first 會自動調整欄位型別（例如整數金額被更新為小數）
+                    df_main[col] = df_existing[col].combine_first(df_main[col]).reindex(df_main.index)
+            if not df_added.empty:
+                df_main = pd.concat([df_main, df_added]) if not df_main.empty else df_added
+
+            self._df_main = gr.convert_column_types(df_main, MAIN_SHEET)
+            self._changes = {}
+            return self._df_main
+
+
+def merge_sum_tables(df_base: pd.DataFrame, df_delta: pd.DataFrame) -> pd.DataFrame:
+    """將之後交易紀錄的彙總表（df_delta）累加到先前的彙總表（df_base）"""
+    cols = ['會員編號', '方案', '剩餘堂數', '剩餘預收款項', '最近交易日期']
+    df_all = pd.concat([df_base[cols].astype({"方案": object}), df_delta[cols].astype({"方案": object})],
+                       ignore_index=True)
+    df_sum = df_all.groupby(["會員編號", "方案"]).agg(
+        剩餘堂數=("剩餘堂數", "sum"),
+        剩餘預收款項=("剩餘預收款項", "sum"),
+        最近交易日期=("最近交易日期", "last")
+    ).reset_index()
+    df_sum["平均單堂金額"] = get_avg_price(df_sum["剩餘預收款項"], df_sum["剩餘堂數"])
+
+    return df_sum[SUM_COLS]
+
+
+def _load_checkpoint(df_event: pd.DataFrame):
+    """載入與交易紀錄相符的檢查點，不存在或不符（交易紀錄曾被修改）時回傳 (None, 0)"""
+    df_checkpoint, event_count, last_event = ckpt.get_checkpoint().load()
+    if (df_checkpoint is None or event_count > len(df_event)
+            or last_event != ckpt.event_marker(df_event, event_count)):
+        return None, 0
+    return df_checkpoint, event_count
+
+
+def get_current_sum_table(df_event: pd.DataFrame) -> pd.DataFrame:
+    """
+    以最新的結餘檢查點加上其後的交易紀錄計算彙總表，結果與 get_sum_table 相同
+    只讀取檢查點，不會建立檢查點（df_event 可能含尚未寫入的交易紀錄）；檢查點不可用時完整重算
+    """
+    df_checkpoint, event_count = _load_checkpoint(df_event)
+    if df_checkpoint is None:
+        return get_sum_table(df_event)
+
+    return merge_sum_tables(df_checkpoint, get_sum_table(df_event.iloc[event_count:]))
+
+
+def refresh_checkpoint(df_event: pd.DataFrame) -> bool:
+    """
+    以已寫入資料庫的交易紀錄更新結餘檢查點（寫入成功後呼叫）
+    檢查點不存在、與交易紀錄不符，或其後累積超過 CHECKPOINT_INTERVAL 筆時才建立新的檢查點
+    Returns:
+        是否建立了新的檢查點
+    """
+    df_checkpoint, event_count = _load_checkpoint(df_event)
+    if df_checkpoint is not None and len(df_event) - event_count < CHECKPOINT_INTERVAL:
+        return False
+
+    if df_checkpoint is None:
+        df_sum = get_sum_table(df_event)
+    else:
+        df_sum = merge_sum_tables(df_checkpoint, get_sum_table(df_event.iloc[event_count:]))
+    ckpt.get_checkpoint().save(df_sum, len(df_event), ckpt.event_marker(df_event, len(df_event)))
+    return True
+
+
+def get_df_main(df_event: pd.DataFrame, df_member: pd.DataFrame, df_sum: pd.DataFrame = None) -> pd.DataFrame:
+    if df_sum is None:
+        df_sum = get_current_sum_table(df_event=df_event)
+
+    df_member = df_member[MEMBER_COLS]
 
     df_main = df_member.merge(df_sum, how="inner", on=['會員編號'])
 
@@ -34,7 +221,34 @@ def get_df_main(df_event: pd.DataFrame, df_member: pd.DataFrame) -> pd.DataFrame
     return df_main
 
 
-def D_update_main_data(df_event: pd.DataFrame = None, df_member: pd.DataFrame = None):
+def get_main_changes(df_new: pd.DataFrame, engine: BalanceEngine, df_member: pd.DataFrame = None) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    以新事件計算主表的變動：只計算有變動的 (會員編號, 方案)，不重新彙總全部交易紀錄
+    Returns:
+        (df_updated: 被覆寫的既有列, df_added: 附加在最後的新列)
+    """
+    # 新事件轉為與讀取時相同的欄位型別（例如交易日期為日期型別）
+    df_new = gr.convert_column_types(df_new.copy(), EVENT_SHEET)
+    return engine.changes(df_new, df_member=df_member)
+
+
+def main_write_ops(engine: BalanceEngine, df_updated: pd.DataFrame, df_added: pd.DataFrame) -> list[storage.WriteOp]:
+    """
+    主表的寫入：覆寫有變動的列，新的 (會員, 方案) 附加在最後
+    以寫入前的列數，以及被覆寫的列在寫入前的會員、方案與結餘作為版本
+    （覆寫不會改變列數，其他使用者同時更新同一列時只能由內容發現）
+    """
+    base_rows = engine.row_count
+    expected_values = engine.get_rows(list(df_updated.index), MAIN_VERSION_COLS) if not df_updated.empty else None
+    return [
+        storage.WriteOp("update_rows", MAIN_SHEET, df_updated, expected_rows=base_rows,
+                        expected_values=expected_values),
+        storage.WriteOp("append", MAIN_SHEET, df_added, expected_rows=base_rows),
+    ]
+
+
+def D_update_main_data(df_event: pd.DataFrame = None, df_member: pd.DataFrame = None, write_checkpoint: bool = True):
+    """完整重算主表（手動更新使用），write_checkpoint=True 時同時以重算結果建立新的結餘檢查點"""
     try:
         # 讀入事件紀錄表
         if df_event is None:
@@ -44,8 +258,13 @@ def D_update_main_data(df_event: pd.DataFrame = None, df_member: pd.DataFrame =
         if df_member is None:
             df_member = gr.GET_DF_FROM_DB(sheet=MEMBER_SHEET)
 
+        # 重新彙總全部交易紀錄，不使用檢查點
+        df_sum = get_sum_table(df_event)
+        if write_checkpoint:
+            ckpt.get_checkpoint().save(df_sum, len(df_event), ckpt.event_marker(df_event, len(df_event)))
+
         # 重新計算main表
-        df_main = get_df_main(df_event=df_event, df_member=df_member)
+        df_main = get_df_main(df_event=df_event, df_member=df_member, df_sum=df_sum)
 
         # 存檔
         success, msg = gr.SAVE_TO_SHEET(df=df_main, sheet=MAIN_SHEET)
@@ -1,28 +1,30 @@
 from mod import D_main_table as mt
 from mod import O_general as gr
+from mod import O_transaction as txn
 from mod.O_config import EVENT_SHEET, MEMBER_SHEET
+from mod.O_lookup import LookupSnapshot
 from datetime import datetime
 import pandas as pd
 
 
 def get_member_stock(member_id: str, plan: str, df_event: pd.DataFrame = None, df_member: pd.DataFrame = None):
-    """取得特定會員特定方案的庫存狀況"""
-    try:
-        if df_event is None:
-            df_event = gr.GET_DF_FROM_DB(sheet=EVENT_SHEET)
-        if df_member is None:
-            df_member = gr.GET_DF_FROM_DB(sheet=MEMBER_SHEET)
-        df_main = mt.get_df_main(df_event=df_event, df_member=df_member)
-
-        mask1 = (df_main["會員編號"] == member_id)
-        mask2 = (df_main["方案"] == plan)
-        result = df_main[mask1 & mask2]
-        return result
-    except Exception as e:
-        return pd.DataFrame()
+    """
+    取得特定會員特定方案的庫存狀況
+    讀取失敗時直接拋出例外，不可視為查無紀錄（佇列中的退款會因此被判定為不成立）
+    """
+    if df_event is None:
+        df_event = gr.GET_DF_FROM_DB(sheet=EVENT_SHEET)
+    if df_member is None:
+        df_member = gr.GET_DF_FROM_DB(sheet=MEMBER_SHEET)
+    df_main = mt.get_df_main(df_event=df_event, df_member=df_member)
+
+    mask1 = (df_main["會員編號"] == member_id)
+    mask2 = (df_main["方案"] == plan)
+    result = df_main[mask1 & mask2]
+    return result
 
 
-def validate_refund(member_id: str, plan: str, coach_name: str, remarks: str = "", df_event: pd.DataFrame = None, df_member: pd.DataFrame = None, df_coach: pd.DataFrame = None) -> tuple[bool, str, dict]:
+def validate_refund(member_id: str, plan: str, coach_name: str, remarks: str = "", df_event: pd.DataFrame = None, df_member: pd.DataFrame = None, df_coach: pd.DataFrame = None, lookup: LookupSnapshot = None) -> tuple[bool, str, dict]:
     """
     驗證退款資料
     Args:
@@ -60,7 +62,7 @@ def validate_refund(member_id: str, plan: str, coach_name: str, remarks: str = "
         else:
             price = 0
 
-        coach_id, _ = gr.get_coach_id(coach=coach_name, df_coach=df_coach)
+        coach_id, _ = gr.get_coach_id(coach=coach_name, df_coach=df_coach, lookup=lookup)
         today = datetime.now().date().strftime("%Y-%m-%d")
         now_time = datetime.now().time().strftime("%H:%M:%S")
 
@@ -89,6 +91,26 @@ def validate_refund(member_id: str, plan: str, coach_name: str, remarks: str = "
         return False, f"驗證過程發生錯誤: {str(e)}", {}
 
 
+def recheck_refund(record: dict, df_event: pd.DataFrame, df_member: pd.DataFrame = None) -> pd.DataFrame:
+    """以最新的交易紀錄重新計算退款堂數與金額，已無可退款項時拋出 InputError"""
+    result = get_member_stock(record["會員編號"], record["方案"], df_event=df_event, df_member=df_member)
+    if result.empty:
+        raise gr.InputError("查無該會員此方案的紀錄")
+
+    remaining_count = result["剩餘堂數"].iloc[0]
+    remaining_total = result["剩餘預收款項"].iloc[0]
+    if remaining_count == 0 and remaining_total == 0:
+        raise gr.InputError("該方案已無剩餘堂數與款項，無法退款")
+    if remaining_count < 0 or remaining_total < 0:
+        raise gr.InputError("該方案數據異常（為負數），請先檢查數據")
+
+    record = dict(record)
+    record["堂數"] = remaining_count * (-1)
+    record["方案總金額"] = remaining_total * (-1)
+    record["單堂金額"] = round((remaining_total / remaining_count), 2) if remaining_count > 0 else 0
+    return pd.DataFrame([record])
+
+
 def execute_refund(data: dict, df_event: pd.DataFrame = None, df_member: pd.DataFrame = None) -> tuple[bool, str]:
     """
     執行退款寫入
@@ -102,20 +124,14 @@ def execute_refund(data: dict, df_event: pd.DataFrame = None, df_member: pd.Data
 
         refund_record = [record]
         
-        if df_event is None:
-            df_event = gr.GET_DF_FROM_DB(sheet=EVENT_SHEET)
+        # 只附加退款紀錄，不重寫整張事件表
+        # 寫入前依最新的交易紀錄（含同時送出的其他交易）重新計算退款堂數與金額
         df_refund = pd.DataFrame(refund_record)
-        df_event = pd.concat([df_event, df_refund], ignore_index=True)
-
-        success, msg = gr.SAVE_TO_SHEET(df=df_event, sheet=EVENT_SHEET)
+        success, msg, df_refund = txn.get_coordinator().submit_events(
+            df_new=df_refund, df_event=df_event, df_member=df_member,
+            rebuild=lambda df_latest: recheck_refund(record, df_latest, df_member=df_member))
 
         if success:
-             # 更新主表
-            try:
-                mt.D_update_main_data(df_event=df_event, df_member=df_member)
-            except Exception as e:
-                return True, f"退款紀錄儲存成功，但主表更新失敗: {e}"
-            
             return True, "退款成功！已歸零該方案剩餘堂數與款項。"
         else:
             return False, msg
@@ -1,29 +1,92 @@
-from mod import D_main_table as mt
 from mod import O_general as gr
-from mod.O_config import EVENT_SHEET, MEMBER_SHEET
-from datetime import datetime
+from mod.O_config import MAIN_SHEET, MEMBER_SHEET
+from datetime import date, datetime, timedelta
+import numpy as np
 import pandas as pd
 
+MEMBER_INFO_COLS = ['會員編號', '會員姓名', '生日', '電話', '教練', '加入日期', '加入時間']
+BALANCE_COLS = ['會員編號', '方案', '剩餘堂數', '平均單堂金額', '剩餘預收款項', '最近交易日期']
+OUTPUT_COLS = ['會員編號', '會員姓名', '生日', '電話', '教練', '方案',
+               '剩餘堂數', '平均單堂金額', '剩餘預收款項', '最近交易日期', '加入日期', '加入時間']
 
-def get_birthday_member(df_event: pd.DataFrame = None, df_member: pd.DataFrame = None):
-    if df_event is None:
-        df_event = gr.GET_DF_FROM_DB(sheet=EVENT_SHEET)
-    if df_member is None:
-        df_member = gr.GET_DF_FROM_DB(sheet=MEMBER_SHEET)
-    df_member["生日"] = pd.to_datetime(df_member["生日"])
 
-    month = datetime.now().month
-    mask = (df_member["生日"].dt.month == month)
-    df_birthday = df_member[mask]
+class BirthdayIndex:
+    """
+    會員生日索引，每個會員表版本建立一次
+    - 生日只解析一次，依 (月, 日) 分組保存各會員在會員表中的位置
+    - 查詢當月或未來 N 天的壽星時只取出符合的會員，不需掃描整張會員表
+    """
 
-    df_main = mt.get_df_main(df_event=df_event, df_member=df_member)
+    def __init__(self, df_member: pd.DataFrame):
+        # 會員表為各使用者共用的快取資料，不可直接修改
+        birthday = pd.to_datetime(df_member["生日"], errors="coerce")
+        valid = birthday.notna().to_numpy()
+        df = df_member.loc[valid, [col for col in MEMBER_INFO_COLS if col in df_member.columns]]
+        birthday = birthday[valid]
+        self._df = df.assign(生日=birthday.dt.date).reset_index(drop=True)
 
-    df_birthday = df_birthday.merge(df_main, how="inner", on=[
-                                    "會員編號", "會員姓名", "生日", "電話"])
-    df_birthday["生日"] = df_birthday["生日"].dt.date
-    new_cols = ['會員編號', '會員姓名', '生日', '電話', '教練', '方案',
-                '剩餘堂數', '平均單堂金額', '剩餘預收款項', '最近交易日期', '加入日期', '加入時間']
+        # 以 月*100+日 作為分組鍵，例如 3 月 5 日為 305
+        codes = (birthday.dt.month * 100 + birthday.dt.day).to_numpy()
+        self._buckets = pd.Series(codes).groupby(codes).indices
 
-    df_birthday = df_birthday[new_cols]
+    def _rows(self, keys: list[tuple[int, int]]) -> pd.DataFrame:
+        positions = [self._buckets[month * 100 + day] for month, day in keys if month * 100 + day in self._buckets]
+        if not positions:
+            return self._df.iloc[:0]
+        return self._df.take(np.concatenate(positions))
 
-    return df_birthday
+    def month(self, month: int) -> pd.DataFrame:
+        """當月壽星（依生日日期排序）"""
+        return self._rows([(month, day) for day in range(1, 32)])
+
+    def upcoming(self, days: int, today: date = None) -> pd.DataFrame:
+        """
+        今天起 days 天內（含今天）生日的會員，依距離生日的天數排序
+        2 月 29 日生日的會員在非閏年視為 2 月 28 日生日
+        """
+        if today is None:
+            today = datetime.now().date()
+        frames = []
+        for offset in range(max(days, 0) + 1):
+            day = today + timedelta(days=offset)
+            keys = [(day.month, day.day)]
+            if (day.month, day.day) == (2, 28) and (day + timedelta(days=1)).month == 3:
+                keys.append((2, 29))
+            df_day = self._rows(keys)
+            if not df_day.empty:
+                frames.append(df_day.assign(距離生日天數=offset))
+        if not frames:
+            return self._df.iloc[:0].assign(距離生日天數=pd.Series(dtype="int64"))
+        return pd.concat(frames, ignore_index=True)
+
+
+def join_balance(df_birthday: pd.DataFrame, df_main: pd.DataFrame) -> pd.DataFrame:
+    """將壽星與主表（各方案結餘）合併，只取出符合的會員，不需重新彙總交易紀錄"""
+    extra_cols = [col for col in df_birthday.columns if col not in MEMBER_INFO_COLS]
+    df_balance = df_main.loc[df_main["會員編號"].isin(df_birthday["會員編號"]).to_numpy(), BALANCE_COLS]
+    df_result = df_birthday.merge(df_balance, how="inner", on="會員編號")
+    return df_result.reindex(columns=OUTPUT_COLS + extra_cols)
+
+
+def get_birthday_member(month: int = None, df_main: pd.DataFrame = None, df_member: pd.DataFrame = None,
+                        index: BirthdayIndex = None) -> pd.DataFrame:
+    """取得當月（或指定月份）壽星與其各方案結餘"""
+    if index is None:
+        index = BirthdayIndex(df_member if df_member is not None else gr.GET_DF_FROM_DB(sheet=MEMBER_SHEET))
+    if df_main is None:
+        df_main = gr.GET_DF_FROM_DB(sheet=MAIN_SHEET)
+    if month is None:
+        month = datetime.now().month
+
+    return join_balance(index.month(month), df_main)
+
+
+def get_upcoming_birthday_member(days: int, df_main: pd.DataFrame = None, df_member: pd.DataFrame = None,
+                                 index: BirthdayIndex = None, today: date = None) -> pd.DataFrame:
+    """取得未來 days 天內生日的會員與其各方案結餘"""
+    if index is None:
+        index = BirthdayIndex(df_member if df_member is not None else gr.GET_DF_FROM_DB(sheet=MEMBER_SHEET))
+    if df_main is None:
+        df_main = gr.GET_DF_FROM_DB(sheet=MAIN_SHEET)
+
+    return join_balance(index.upcoming(days, today=today), df_main)
@@ -0,0 +1,113 @@
+from datetime import datetime
+import pandas as pd
+from mod import D_main_table as mt
+from mod import O_cache as cache
+from mod import O_checkpoint as ckpt
+from mod import O_general as gr
+from mod import O_storage as storage
+from mod.O_config import EVENT_ARCHIVE_SHEET, EVENT_SHEET, OPENING_BALANCE_PAYMENT
+
+
+def get_opening_rows(df_closed: pd.DataFrame, cutoff_year: int) -> pd.DataFrame:
+    """
+    將已結束年度的交易紀錄彙總為期初結轉列，每個 (會員編號, 方案) 一列
+    堂數與方案總金額為結餘，交易日期為最近交易日期，主表的計算結果不變
+    """
+    df_sum = mt.get_sum_table(df_closed)
+    last_names = df_closed.groupby("會員編號", observed=True)["會員姓名"].last()
+    names = dict(zip(last_names.index.astype(str), last_names.astype(str)))
+    member_ids = df_sum["會員編號"].astype(str)
+
+    df_opening = pd.DataFrame({
+        "會員編號": member_ids,
+        "會員姓名": member_ids.map(names),
+        "方案": df_sum["方案"].astype(str),
+        "堂數": df_sum["剩餘堂數"],
+        "單堂金額": df_sum["平均單堂金額"],
+        "方案總金額": df_sum["剩餘預收款項"],
+        "教練": "",
+        "付款方式": OPENING_BALANCE_PAYMENT,
+        "匯款末五碼": "無",
+        "交易日期": df_sum["最近交易日期"],
+        "備註": f"{cutoff_year - 1}年底結轉"
+    })
+    return df_opening.reindex(columns=df_closed.columns)
+
+
+def archive_closed_years(cutoff_year: int = None, df_event: pd.DataFrame = None) -> tuple[bool, str]:
+    """
+    將 cutoff_year（不含）以前的交易紀錄封存至各年度分頁，
+    B_event 改為以期初結轉列取代已封存的交易，只保留當期交易
+    """
+    try:
+        if cutoff_year is None:
+            cutoff_year = datetime.now().year
+        if df_event is None:
+            df_event = gr.GET_DF_FROM_DB(sheet=EVENT_SHEET)
+
+        is_closed = (df_event["交易日期"].dt.year < cutoff_year).to_numpy()
+        df_closed = df_event[is_closed]
+        # 先前的期初結轉列已包含在新的結轉列中，不需封存
+        df_archive = df_closed[df_closed["付款方式"] != OPENING_BALANCE_PAYMENT]
+        if df_archive.empty:
+            return True, f"{cutoff_year} 年以前沒有需要封存的交易紀錄"
+
+        # 1. 依年度寫入封存分頁（先寫入封存，B_event 尚未異動，失敗時可重新執行）
+        backend = storage.get_backend()
+        years = sorted(df_archive["交易日期"].dt.year.unique())
+        for year, df_year in df_archive.groupby(df_archive["交易日期"].dt.year):
+            sheet = EVENT_ARCHIVE_SHEET.format(year=year)
+            if backend.exists(sheet):
+                # 重新執行時已封存過的交易不重複寫入
+                df_year = pd.concat([gr.GET_DF_FROM_DB(sheet=sheet), df_year]).drop_duplicates(ignore_index=True)
+            success, msg = gr.SAVE_TO_SHEET(df=df_year, sheet=sheet)
+            if not success:
+                return False, f"封存 {year} 年度交易紀錄失敗：{msg}"
+
+        # 2. B_event 改為期初結轉列加上當期交易
+        df_opening = get_opening_rows(df_closed, cutoff_year)
+        df_current = df_event[~is_closed]
+        df_hot = pd.concat([df_opening, df_current], ignore_index=True) if not df_current.empty else df_opening
+        df_hot = gr.convert_column_types(df_hot, EVENT_SHEET)
+
+        # 以讀取時的列數作為版本，封存期間若有新增的交易則不覆寫，避免遺失該交易
+        try:
+            success, msg = gr.SAVE_TO_SHEET(df=df_hot, sheet=EVENT_SHEET, expected_rows=len(df_event))
+        except storage.VersionConflict:
+            return False, f"封存期間 {EVENT_SHEET} 有新增的交易紀錄，請重新執行封存"
+        if not success:
+            return False, f"封存完成，但更新 {EVENT_SHEET} 失敗：{msg}"
+
+        # 3. 交易紀錄的位置已改變，重新建立結餘檢查點並更新快取
+        ckpt.get_checkpoint().save(mt.get_sum_table(df_hot), len(df_hot), ckpt.event_marker(df_hot, len(df_hot)))
+        cache.publish(EVENT_SHEET, df_hot)
+
+        year_text = "、".join(str(year) for year in years)
+        return True, f"已封存 {year_text} 年度共 {len(df_archive)} 筆交易紀錄，並建立 {len(df_opening)} 筆期初結轉"
+
+    except Exception as e:
+        return False, f"封存交易紀錄失敗：{str(e)}"
+
+
+def read_event_history(start_year: int, end_year: int = None) -> pd.DataFrame:
+    """
+    查詢 start_year 至 end_year 的完整交易紀錄（含已封存的年度，不含期初結轉列）
+    """
+    if end_year is None:
+        end_year = datetime.now().year
+
+    backend = storage.get_backend()
+    frames = []
+    for year in range(start_year, end_year + 1):
+        sheet = EVENT_ARCHIVE_SHEET.format(year=year)
+        if backend.exists(sheet):
+            frames.append(gr.GET_DF_FROM_DB(sheet=sheet))
+
+    df_event = gr.GET_DF_FROM_DB(sheet=EVENT_SHEET)
+    frames.append(df_event[df_event["付款方式"] != OPENING_BALANCE_PAYMENT])
+
+    frames = [df for df in frames if not df.empty] or [df_event.iloc[:0]]
+    df_history = pd.concat(frames, ignore_index=True)
+    df_history = gr.convert_column_types(df_history, EVENT_SHEET)
+    years = df_history["交易日期"].dt.year
+    return df_history[(years >= start_year) & (years <= end_year)].reset_index(drop=True)
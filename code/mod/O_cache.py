@@ -0,0 +1,223 @@
+import threading
+import pandas as pd
+from mod import D_main_table as mt
+from mod import O_general as gr
+from mod import O_storage as storage
+from mod.O_config import COACH, EVENT_SHEET, MAIN_SHEET, MEMBER_SHEET, MENU
+
+ALL_SHEETS = [MEMBER_SHEET, EVENT_SHEET, COACH, MENU, MAIN_SHEET]
+
+# 各操作成功後會異動的分頁，只有這些分頁的快取需要失效
+ACTION_SHEETS = {
+    "add_member": [MEMBER_SHEET],
+    "purchase": [EVENT_SHEET, MAIN_SHEET],
+    "customized_purchase": [EVENT_SHEET, MAIN_SHEET],
+    "consume": [EVENT_SHEET, MAIN_SHEET],
+    "refund": [EVENT_SHEET, MAIN_SHEET],
+    # 手動更新用於同步直接修改試算表的內容，所有分頁都需重新讀取
+    "manual_update": ALL_SHEETS,
+}
+
+
+class SheetVersions:
+    """
+    記錄每個分頁的版本號，作為快取的 key
+    分頁被寫入後版本號加一，舊版本的快取自然不再被使用
+    """
+
+    def __init__(self):
+        self._versions = {}
+        # 可重入，發布資料時可在持有鎖的情況下更新版本號
+        self.lock = threading.RLock()
+
+    def get(self, sheet: str) -> int:
+        return self._versions.get(sheet, 0)
+
+    def snapshot(self, sheets: list[str]) -> dict[str, int]:
+        """同時取得多個分頁的版本號，不會讀到寫入流程只更新一半的版本"""
+        with self.lock:
+            return {sheet: self._versions.get(sheet, 0) for sheet in sheets}
+
+    def bump(self, sheets: list[str]):
+        with self.lock:
+            for sheet in sheets:
+                self._versions[sheet] = self._versions.get(sheet, 0) + 1
+
+
+# 整個程序共用，所有使用者的快取一起失效
+sheet_versions = SheetVersions()
+
+
+def get_version(sheet: str) -> int:
+    return sheet_versions.get(sheet)
+
+
+def get_versions(sheets: list[str] = None) -> dict[str, int]:
+    """取得一組一致的分頁版本號（預設為所有分頁）"""
+    return sheet_versions.snapshot(sheets or ALL_SHEETS)
+
+
+def invalidate(sheets: list[str]):
+    """讓指定分頁的快取失效"""
+    sheet_versions.bump(sheets)
+
+
+def invalidate_action(action: str):
+    """依操作類型讓對應分頁的快取失效"""
+    invalidate(ACTION_SHEETS.get(action, ALL_SHEETS))
+
+
+# 各分頁目前保存的資料 {分頁: (版本號, DataFrame)}，每個分頁只保留最新版本的一份
+# 寫入流程發布的資料與讀取的資料都存放在這裡，新版本放入後舊版本即可被釋放
+# 主表由交易寫入發布時保存的是結餘引擎，第一次讀取時才產生完整的 DataFrame
+_frames = {}
+# 同一分頁同時只讀取一次
+_load_locks = {}
+# 主表目前版本的結餘引擎 (版本號, BalanceEngine)，每個主表版本只建立一次
+_main_engine = None
+
+
+def _frame(data) -> pd.DataFrame:
+    return data if isinstance(data, pd.DataFrame) else data.to_frame()
+
+
+def publish(sheet: str, df: pd.DataFrame, verify: bool = True):
+    """
+    發布分頁寫入後的完整資料：版本號加一，並讓新版本直接使用這份資料
+    verify=True 時會在背景與遠端資料比對，不一致就讓快取失效
+    """
+    # 轉為與讀取時相同的欄位型別
+    df = gr.convert_column_types(df, sheet)
+
+    # 先放入資料再讓新版本號生效，讀到新版本號的使用者一定取得這份資料
+    with sheet_versions.lock:
+        version = sheet_versions.get(sheet) + 1
+        _frames[sheet] = (version, df)
+        sheet_versions.bump([sheet])
+
+    if verify:
+        threading.Thread(target=_verify_published, args=(sheet, version), daemon=True).start()
+
+
+def get_published(sheet: str, version: int) -> pd.DataFrame | None:
+    """取得指定版本的資料（寫入流程發布或已讀取），沒有則回傳 None"""
+    entry = _frames.get(sheet)
+    if entry is not None and entry[0] == version:
+        return _frame(entry[1])
+    return None
+
+
+def get_main_engine() -> mt.BalanceEngine | None:
+    """
+    取得最新版本主表的結餘引擎，由該版本的主表建立（每個版本只建立一次）
+    本程序沒有最新版本的主表時回傳 None
+    """
+    global _main_engine
+    with sheet_versions.lock:
+        version = sheet_versions.get(MAIN_SHEET)
+        if _main_engine is not None and _main_engine[0] == version:
+            return _main_engine[1]
+        entry = _frames.get(MAIN_SHEET)
+    if entry is None or entry[0] != version:
+        return None
+
+    engine = entry[1] if isinstance(entry[1], mt.BalanceEngine) else mt.BalanceEngine(entry[1])
+    with sheet_versions.lock:
+        if sheet_versions.get(MAIN_SHEET) != version:
+            return None
+        _main_engine = (version, engine)
+    return engine
+
+
+def publish_main_engine(engine: mt.BalanceEngine, verify: bool = True):
+    """
+    發布套用交易後的主表：版本號加一，新版本直接使用這個結餘引擎
+    不需複製整張主表，完整的主表在第一次讀取時才產生
+    """
+    global _main_engine
+    with sheet_versions.lock:
+        version = sheet_versions.get(MAIN_SHEET) + 1
+        _frames[MAIN_SHEET] = (version, engine)
+        _main_engine = (version, engine)
+        sheet_versions.bump([MAIN_SHEET])
+
+    if verify:
+        threading.Thread(target=_verify_published, args=(MAIN_SHEET, version), daemon=True).start()
+
+
+def get_sheet(sheet: str, version: int, loader) -> pd.DataFrame:
+    """
+    取得分頁資料：保存的資料版本不低於 version 時直接回傳，否則以 loader() 讀取並取代舊版本
+    所有使用者共用同一份資料、不需複製，取得的 DataFrame 不可直接修改
+    """
+    entry = _frames.get(sheet)
+    if entry is not None and entry[0] >= version:
+        return _frame(entry[1])
+
+    with sheet_versions.lock:
+        load_lock = _load_locks.setdefault(sheet, threading.Lock())
+    with load_lock:
+        # 等待期間其他使用者可能已讀取或發布了該版本
+        entry = _frames.get(sheet)
+        if entry is not None and entry[0] >= version:
+            return _frame(entry[1])
+
+        df = loader()
+        with sheet_versions.lock:
+            entry = _frames.get(sheet)
+            # 讀取期間寫入流程已發布更新的版本時保留發布的資料
+            if entry is None or entry[0] < version:
+                _frames[sheet] = (version, df)
+        return df
+
+
+def patch_append(sheet: str, base_df: pd.DataFrame | None, df_new: pd.DataFrame):
+    """
+    將新附加的資料列合併到快取中的資料並發布
+    沒有快取資料可合併時，改為讓該分頁快取失效
+    """
+    if base_df is None:
+        invalidate([sheet])
+        return
+
+    if base_df.empty:
+        publish(sheet, df_new.reset_index(drop=True))
+        return
+
+    # 先轉為與讀取時相同的欄位型別（例如交易日期與交易時間合併），再只保留分頁既有的欄位
+    df_new = gr.convert_column_types(df_new.copy(), sheet)
+
+    # index 代表資料列位置，新資料接在最後一列之後
+    start = int(base_df.index.max()) + 1
+    df_new = df_new.reindex(columns=base_df.columns).set_axis(range(start, start + len(df_new)))
+    df = pd.concat([base_df, df_new])
+    publish(sheet, df)
+
+
+def _verify_published(sheet: str, version: int):
+    """
+    背景比對已發布的資料與遠端的資料列數及最後一列的第一欄（例如會員編號），不一致時讓快取失效重新讀取
+    只讀取遠端第一欄中本地最後一列之後的部分，不下載整欄或整張分頁
+    """
+    try:
+        entry = _frames.get(sheet)
+        if entry is None or entry[0] != version:
+            return
+        # 主表的結餘引擎不需產生完整主表即可取得列數與最後一列
+        if isinstance(entry[1], pd.DataFrame):
+            local_rows = len(entry[1])
+            local_last = entry[1].iloc[-1, 0] if local_rows else None
+        else:
+            local_rows, local_last = entry[1].tail()
+        # 以本地的列數作為預期的列數，只讀取遠端第一欄中其後的部分
+        row_count, last_value = storage.get_backend().tail(sheet, expected_rows=local_rows)
+
+        consistent = local_rows == row_count
+        if consistent and row_count > 0:
+            consistent = storage.same_value(local_last, last_value)
+
+        entry = _frames.get(sheet)
+        if not consistent and entry is not None and entry[0] == version:
+            invalidate([sheet])
+    except Exception as e:
+        print(f"背景比對 {sheet} 失敗：{e}")
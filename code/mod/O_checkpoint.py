@@ -0,0 +1,119 @@
+import hashlib
+import sqlite3
+import threading
+from contextlib import closing
+from datetime import datetime
+import pandas as pd
+from mod import O_config as config
+from mod.O_storage import PROJECT_ROOT
+
+CHECKPOINT_COLS = ['會員編號', '方案', '剩餘堂數', '剩餘預收款項', '最近交易日期']
+# 計算結餘用到的欄位，這些欄位的內容被修改時檢查點必須失效
+MARKER_COLS = ['會員編號', '方案', '堂數', '方案總金額']
+
+
+def event_marker(df_event: pd.DataFrame, event_count: int) -> str:
+    """
+    以前 event_count 筆交易紀錄（檢查點涵蓋的範圍）的會員編號、方案、堂數與方案總金額計算雜湊作為標記，
+    涵蓋範圍內任一筆交易紀錄被直接修改或刪除時標記不同，檢查點即失效
+    """
+    if event_count == 0:
+        return ""
+    df = df_event[MARKER_COLS].iloc[:event_count]
+    # 統一型別，同樣的內容不論讀取或寫入後的型別（例如整數與浮點數）都得到相同的雜湊
+    df = df.astype({'會員編號': str, '方案': str}).assign(
+        堂數=pd.to_numeric(df['堂數'], errors='coerce').astype(float),
+        方案總金額=pd.to_numeric(df['方案總金額'], errors='coerce').astype(float))
+    digest = hashlib.sha256(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes()).hexdigest()
+    return f"{event_count}|{digest}"
+
+
+class BalanceCheckpoint:
+    """
+    結餘檢查點（本地 SQLite）
+    保存截至第 N 筆交易紀錄的各 (會員編號, 方案) 結餘，
+    重算時載入檢查點後只需累加第 N 筆之後的交易紀錄
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._loaded = None
+        self._lock = threading.Lock()
+
+        with closing(self._connect()) as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS balances (
+                    會員編號 TEXT NOT NULL,
+                    方案 TEXT NOT NULL,
+                    剩餘堂數 INTEGER NOT NULL,
+                    剩餘預收款項 REAL NOT NULL,
+                    最近交易日期 TEXT
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS meta (
+                    event_count INTEGER NOT NULL,
+                    last_event TEXT NOT NULL,
+                    created_at TEXT NOT NULL
+                )
+            """)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def save(self, df_sum: pd.DataFrame, event_count: int, last_event: str):
+        """以彙總表覆寫檢查點，結餘與筆數在同一個交易中寫入"""
+        df_sum = df_sum[CHECKPOINT_COLS]
+        dates = pd.to_datetime(df_sum["最近交易日期"], errors="coerce").dt.strftime("%Y-%m-%d")
+        rows = [
+            (str(member_id), str(plan), int(count), float(total), date if isinstance(date, str) else None)
+            for member_id, plan, count, total, date in zip(
+                df_sum["會員編號"], df_sum["方案"], df_sum["剩餘堂數"], df_sum["剩餘預收款項"], dates)
+        ]
+        created_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+        with self._lock, closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("DELETE FROM balances")
+                conn.executemany("INSERT INTO balances VALUES (?, ?, ?, ?, ?)", rows)
+                conn.execute("DELETE FROM meta")
+                conn.execute("INSERT INTO meta VALUES (?, ?, ?)", (event_count, last_event, created_at))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            self._loaded = None
+
+    def load(self) -> tuple[pd.DataFrame | None, int, str]:
+        """
+        讀取檢查點（讀取一次後保留在記憶體中）
+        Returns:
+            (df_sum: 結餘表，尚無檢查點時為 None, event_count: 涵蓋的交易紀錄筆數, last_event: 涵蓋範圍的標記，見 event_marker)
+        """
+        with self._lock:
+            if self._loaded is None:
+                with closing(self._connect()) as conn:
+                    meta = conn.execute("SELECT event_count, last_event FROM meta").fetchone()
+                    if meta is None:
+                        return None, 0, ""
+                    df_sum = pd.read_sql_query("SELECT * FROM balances", conn)
+
+                df_sum["最近交易日期"] = pd.to_datetime(df_sum["最近交易日期"], errors="coerce")
+                self._loaded = (df_sum, meta[0], meta[1])
+            return self._loaded
+
+
+_checkpoint = None
+_checkpoint_lock = threading.Lock()
+
+
+def get_checkpoint() -> BalanceCheckpoint:
+    """取得專案目錄下的結餘檢查點（只建立一次）"""
+    global _checkpoint
+    with _checkpoint_lock:
+        if _checkpoint is None:
+            _checkpoint = BalanceCheckpoint(PROJECT_ROOT / config.CHECKPOINT_DATABASE)
+    return _checkpoint
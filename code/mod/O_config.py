@@ -1,7 +1,24 @@
 DATABASE = "member_database.xlsx"
+# 儲存後端："gsheet"（Google Sheets）或 "sqlite"（本地 SQLite 檔案）
+STORAGE_BACKEND = "gsheet"
+SQLITE_DATABASE = "member_database.db"
+# 寫入佇列：開啟後交易先寫入本地佇列即回覆成功，再由背景執行緒同步到資料庫
+WRITE_BEHIND = False
+WRITE_QUEUE_DATABASE = "write_queue.db"
+# 寫入時若資料已被其他使用者更新（版本不同），重新讀取後最多再嘗試的次數
+WRITE_RETRIES = 3
+# 結餘檢查點：重算結餘時只需累加檢查點之後的交易紀錄，累積超過 CHECKPOINT_INTERVAL 筆時自動建立新的檢查點
+CHECKPOINT_DATABASE = "balance_checkpoint.db"
+CHECKPOINT_INTERVAL = 1000
+# 本地鏡像：以 Arrow 格式保存各分頁，啟動時若資料庫未變動即直接讀取本地檔案，不需重新下載
+LOCAL_MIRROR = True
+MIRROR_DIRECTORY = ".mirror"
 MAIN_SHEET = "A_main"
 EVENT_SHEET = "B_event"
 MEMBER_SHEET = "C_member"
 MENU = "menu"
 COACH = "coach"
+# 已結束年度的交易紀錄封存至各年度的分頁（例如 B_event_2024），B_event 只保留期初結轉列與當期交易
+EVENT_ARCHIVE_SHEET = EVENT_SHEET + "_{year}"
+OPENING_BALANCE_PAYMENT = "期初結轉"
 ADMIN_PASSWORD = "1qaz@WSX"
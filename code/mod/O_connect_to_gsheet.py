@@ -1,35 +1,265 @@
+import threading
+import pandas as pd
 import streamlit as st
-from streamlit_gsheets import GSheetsConnection
+from gspread.exceptions import APIError, WorksheetNotFound
+from gspread.utils import absolute_range_name, rowcol_to_a1
+from mod import O_startup as startup
 
+_conn = None
+_conn_lock = threading.Lock()
 
-def conn_to_gsheets():
-    """使用st與google sheet建立連線"""
-    conn = st.connection("gsheets", type=GSheetsConnection)
-    return conn
+# 預期的最後一列已不存在（資料列被刪除）時，往前尋找最後一列的第一段範圍列數（之後每次加倍）
+TAIL_SEARCH_ROWS = 50
+# 各分頁最近一次確認的資料列數，作為下次讀取第一欄的起點（只是起點，與實際不同時會重新尋找）
+_row_counts = {}
 
 
-conn = conn_to_gsheets()
+def conn_to_gsheets():
+    """使用st與google sheet建立連線（第一次存取試算表時才建立，整個程序共用同一個連線）"""
+    global _conn
+    with _conn_lock:
+        if _conn is None:
+            with startup.measure("connect"):
+                from streamlit_gsheets import GSheetsConnection
+                _conn = st.connection("gsheets", type=GSheetsConnection)
+    return _conn
 
 
-def read_sheet_as_df(sheet_name, conn=conn, ttl=0):
-    """讀取特定名稱的sheet分頁"""
-    df_students = conn.read(worksheet=sheet_name, ttl=ttl)
+def read_sheet_as_df(sheet_name, conn=None, ttl=0, dtype=None):
+    """讀取特定名稱的sheet分頁，dtype 指定的欄位在解析時即轉為該型別"""
+    if conn is None:
+        conn = conn_to_gsheets()
+    df_students = conn.read(worksheet=sheet_name, ttl=ttl, dtype=dtype)
 
     return df_students
 
 
-def read_all_sheets(sheet_list, conn=conn):
-    """讀取列表中的所有sheet分頁並存入dict"""
-    all_data = {}
+def update_sheet(sheet_name, updated_df, conn=None):
+    if conn is None:
+        conn = conn_to_gsheets()
+    try:
+        conn.update(
+            worksheet=sheet_name,
+            data=updated_df
+        )
+    except WorksheetNotFound:
+        # 分頁不存在時（例如新的封存年度）建立新分頁
+        conn.create(worksheet=sheet_name, data=updated_df)
+
+
+def get_revision(conn=None):
+    """取得試算表最後修改時間（Drive API），作為資料是否變動的標記"""
+    if conn is None:
+        conn = conn_to_gsheets()
+    return conn.client._open_spreadsheet().get_lastUpdateTime()
+
+
+def get_worksheet(sheet_name, conn=None):
+    """取得 gspread 的 worksheet 物件，供逐列寫入使用"""
+    if conn is None:
+        conn = conn_to_gsheets()
+    return conn.client._select_worksheet(worksheet=sheet_name)
+
+
+def count_rows(sheet_name, row_count=None, conn=None):
+    """
+    分頁的資料列數（不含標題），只讀取第一欄中預期的最後一列（row_count，未指定時為最近一次確認的列數）之後的部分；
+    分頁不存在時為 0
+    """
+    try:
+        return _read_tail(sheet_name, row_count=row_count, conn=conn)[0]
+    except WorksheetNotFound:
+        return 0
+
+
+def get_tail(sheet_name, row_count=None, conn=None):
+    """
+    分頁的資料列數與最後一列第一欄的值（未格式化），沒有資料列時為 (0, None)
+    只讀取第一欄中預期的最後一列（row_count，未指定時為最近一次確認的列數）之後的部分
+    """
+    return _read_tail(sheet_name, row_count=row_count, conn=conn)
+
+
+def _to_cell(value):
+    """將 DataFrame 中的值轉為可送出的儲存格值（空值轉空字串、numpy型別轉原生型別）"""
+    if pd.isna(value):
+        return ""
+    if hasattr(value, "item"):
+        return value.item()
+    return value
+
+
+def df_to_values(df, columns):
+    """依照指定欄位順序，將 DataFrame 轉為二維列表"""
+    df = df.reindex(columns=columns)
+    return [[_to_cell(v) for v in row] for row in df.itertuples(index=False)]
+
+
+def append_rows(sheet_name, new_df, conn=None):
+    """只將新增的資料列附加到分頁最後，不重寫整張表"""
+    worksheet = get_worksheet(sheet_name, conn=conn)
+
+    # 依照分頁的標題列排序欄位，若分頁為空則連同標題一起寫入
+    header = worksheet.row_values(1)
+    rows = []
+    if not header:
+        header = list(new_df.columns)
+        rows.append(header)
+    rows.extend(df_to_values(new_df, header))
+
+    worksheet.append_rows(rows, value_input_option="USER_ENTERED")
+
+
+def row_values(rows_df, columns, sheet_name=None):
+    """
+    將 rows_df 轉為逐列覆寫的範圍，rows_df 的 index 為資料列位置（0 代表標題下的第一列）
+    指定 sheet_name 時範圍包含分頁名稱，可用於整份試算表的批次寫入
+    """
+    data = []
+    for position, values in zip(rows_df.index, df_to_values(rows_df, columns)):
+        row_number = int(position) + 2
+        cells = f"{rowcol_to_a1(row_number, 1)}:{rowcol_to_a1(row_number, len(columns))}"
+        data.append({"range": absolute_range_name(sheet_name, cells) if sheet_name else cells, "values": [values]})
+    return data
+
+
+def append_values(sheet_name, new_df, header, row_count):
+    """將 new_df 轉為接在第 row_count 筆資料之後的範圍，分頁沒有標題列時連同標題一起寫入"""
+    if new_df.empty:
+        return []
+
+    if header:
+        start_row = row_count + 2
+        rows = df_to_values(new_df, header)
+    else:
+        header = list(new_df.columns)
+        start_row = 1
+        rows = [header] + df_to_values(new_df, header)
+
+    cells = f"{rowcol_to_a1(start_row, 1)}:{rowcol_to_a1(start_row + len(rows) - 1, len(header))}"
+    return [{"range": absolute_range_name(sheet_name, cells), "values": rows}]
+
+
+def update_rows(sheet_name, rows_df, columns, conn=None):
+    """
+    只覆寫指定的資料列，rows_df 的 index 為資料列位置（0 代表標題下的第一列）
+    """
+    worksheet = get_worksheet(sheet_name, conn=conn)
+    worksheet.batch_update(row_values(rows_df, columns), value_input_option="USER_ENTERED")
+
+
+def _probe_start(sheet_name, row_count=None, conn=None, grid=False):
+    """
+    讀取第一欄的起始列號：預期的最後一列（第 row_count 筆資料，未指定時為最近一次確認的列數）
+    尚未確認過列數或 grid=True 時以分頁的格線列數為上限，不從第一列開始讀取整欄
+    """
+    if row_count is None:
+        row_count = _row_counts.get(sheet_name)
+    if row_count is not None and not grid:
+        return row_count + 1
+    grid_rows = get_worksheet(sheet_name, conn=conn).row_count
+    return max(min(row_count + 1, grid_rows) if row_count is not None else grid_rows, 1)
+
+
+def _first_column(spreadsheet, sheet_name, cells):
+    """讀取第一欄指定範圍的值（未格式化），回傳的值省略範圍尾端的空白列"""
+    value_range = spreadsheet.values_get(absolute_range_name(sheet_name, cells),
+                                         params={"valueRenderOption": "UNFORMATTED_VALUE"})
+    return value_range.get("values", [])
+
+
+def _find_tail(spreadsheet, sheet_name, start, values):
+    """
+    由第一欄第 start 列之後的值（範圍 A{start}:A）取得資料列數與最後一列第一欄的值
+    start 之後沒有任何資料時（資料列被刪除），以倍增的範圍往前讀取直到找到最後一列；沒有資料列時為 (0, None)
+    """
+    size = TAIL_SEARCH_ROWS
+    while not values and start > 1:
+        end = start - 1
+        start = max(end - size + 1, 1)
+        values = _first_column(spreadsheet, sheet_name, f"A{start}:A{end}")
+        size *= 2
+
+    # 第 1 列為標題列
+    last_row = start + len(values) - 1 if values else 0
+    row_count = max(last_row - 1, 0)
+    _row_counts[sheet_name] = row_count
+    return row_count, (values[-1][0] if row_count > 0 else None)
+
+
+def _read_tail(sheet_name, row_count=None, conn=None):
+    """讀取第一欄中預期的最後一列之後的部分，取得 (資料列數, 最後一列第一欄的值)"""
+    if conn is None:
+        conn = conn_to_gsheets()
+    spreadsheet = conn.client._open_spreadsheet()
+    start = _probe_start(sheet_name, row_count, conn=conn)
+    try:
+        values = _first_column(spreadsheet, sheet_name, f"A{start}:A")
+    except APIError:
+        # 預期的最後一列超出分頁的格線範圍（或分頁不存在），改以格線列數為上限重新讀取
+        start = _probe_start(sheet_name, row_count, conn=conn, grid=True)
+        values = _first_column(spreadsheet, sheet_name, f"A{start}:A")
+    return _find_tail(spreadsheet, sheet_name, start, values)
+
+
+def remember_row_count(sheet_name, row_count):
+    """記錄寫入後的資料列數，下次只需讀取其後新增的列"""
+    _row_counts[sheet_name] = row_count
+
+
+def get_layout(sheet_names, rows=None, row_counts=None, conn=None):
+    """
+    以一次 values.batchGet 取得多個分頁的標題列與資料列數
+    資料列數只讀取第一欄中預期的最後一列之後的部分，不下載整欄：row_counts 為 {分頁名稱: 預期的資料列數}
+    （例如寫入所依據的列數），未指定時使用最近一次確認的列數
+    rows 為 {分頁名稱: [資料列位置]}，指定時一併讀取這些資料列目前的內容（未格式化的值）
+    Returns:
+        {分頁名稱: (標題列, 資料列數, {資料列位置: {欄位: 值}})}
+    """
+    if conn is None:
+        conn = conn_to_gsheets()
+    rows = rows or {}
+    row_counts = row_counts or {}
+    spreadsheet = conn.client._open_spreadsheet()
+
+    def batch_get(starts):
+        ranges = []
+        for sheet_name in sheet_names:
+            ranges += [absolute_range_name(sheet_name, "1:1"), absolute_range_name(sheet_name, f"A{starts[sheet_name]}:A")]
+            ranges += [absolute_range_name(sheet_name, f"{int(p) + 2}:{int(p) + 2}") for p in rows.get(sheet_name, [])]
+        return spreadsheet.values_batch_get(ranges, params={"valueRenderOption": "UNFORMATTED_VALUE"})["valueRanges"]
+
+    starts = {sheet_name: _probe_start(sheet_name, row_counts.get(sheet_name), conn=conn) for sheet_name in sheet_names}
+    try:
+        value_ranges = batch_get(starts)
+    except APIError:
+        # 預期的最後一列超出分頁的格線範圍（例如資料列被刪除），改以格線列數為上限重新讀取
+        starts = {sheet_name: _probe_start(sheet_name, row_counts.get(sheet_name), conn=conn, grid=True)
+                  for sheet_name in sheet_names}
+        value_ranges = batch_get(starts)
 
-    for tab in sheet_list:
-        all_data[tab] = conn.read(worksheet=tab, ttl=0)
+    layout = {}
+    i = 0
+    for sheet_name in sheet_names:
+        header_rows = value_ranges[i].get("values", [])
+        header = [str(col) for col in header_rows[0]] if header_rows else []
+        row_count, _ = _find_tail(spreadsheet, sheet_name, starts[sheet_name], value_ranges[i + 1].get("values", []))
+        i += 2
 
-    return all_data
+        row_contents = {}
+        for position in rows.get(sheet_name, []):
+            values = (value_ranges[i].get("values") or [[]])[0]
+            row_contents[position] = dict(zip(header, values))
+            i += 1
+        layout[sheet_name] = (header, row_count, row_contents)
+    return layout
 
 
-def update_sheet(sheet_name, updated_df, conn=conn):
-    conn.update(
-        worksheet=sheet_name,
-        data=updated_df
-    )
+def batch_update_values(data, conn=None):
+    """將多個分頁的範圍以一次 values.batchUpdate 請求寫入"""
+    if not data:
+        return
+    if conn is None:
+        conn = conn_to_gsheets()
+    conn.client._open_spreadsheet().values_batch_update(
+        body={"valueInputOption": "USER_ENTERED", "data": data})
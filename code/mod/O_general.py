@@ -1,6 +1,8 @@
+import threading
+import numpy as np
 import pandas as pd
-from mod.O_config import COACH, MEMBER_SHEET
-from mod import O_connect_to_gsheet as gs
+from mod.O_config import COACH, EVENT_ARCHIVE_SHEET, EVENT_SHEET, MAIN_SHEET, MEMBER_SHEET, MENU
+from mod import O_storage as storage
 
 
 class InputError(Exception):
@@ -8,48 +10,280 @@ class InputError(Exception):
     pass
 
 
-def GET_DF_FROM_DB(sheet: str):
+# 各分頁的欄位型別
+# string：編號、電話等以字串保存（避免被轉成數字而遺失開頭的 0）
+# category：重複值很多的欄位，以類別型別節省記憶體並加快 groupby
+# int / float：數值欄位；float32：交易紀錄的金額欄位，以較小的型別保存
+# date：日期欄位，讀取時解析一次
+ID_SCHEMA = {
+    '電話': 'string',
+    '匯款末五碼': 'string',
+    '會員編號': 'string',
+    '備註': 'string'
+}
+
+SHEET_SCHEMAS = {
+    MEMBER_SHEET: {
+        '會員編號': 'string', '會員姓名': 'string', '生日': 'string', '電話': 'string',
+        '教練': 'category', '加入日期': 'date', '加入時間': 'string', '備註': 'string'
+    },
+    # 交易紀錄會隨時間持續增加，重複的字串一律以類別保存
+    EVENT_SHEET: {
+        '會員編號': 'category', '會員姓名': 'category', '方案': 'category', '堂數': 'int',
+        '單堂金額': 'float32', '方案總金額': 'float32', '教練': 'category', '付款方式': 'category',
+        '匯款末五碼': 'category', '交易日期': 'date', '交易時間': 'string', '備註': 'category'
+    },
+    MAIN_SHEET: {
+        '會員編號': 'string', '會員姓名': 'string', '生日': 'string', '電話': 'string',
+        '方案': 'category', '剩餘堂數': 'int', '平均單堂金額': 'float', '剩餘預收款項': 'float',
+        '最近交易日期': 'date'
+    },
+    COACH: {'教練編號': 'string', '姓名': 'string', '會員編號': 'string'},
+    MENU: {'plan': 'string', 'name': 'string', 'count': 'int', 'price': 'float', 'total': 'float'},
+}
+
+# 日期與時間分為兩欄保存的分頁，讀取後合併為單一日期時間欄位（存於日期欄位），寫入時再拆回兩欄
+DATETIME_COLUMNS = {
+    EVENT_SHEET: ('交易日期', '交易時間'),
+}
+
+DATE_FORMAT = "%Y-%m-%d"
+TIME_FORMAT = "%H:%M:%S"
+
+
+def _schema_sheet(sheet: str) -> str:
+    """封存的年度交易紀錄分頁與 B_event 使用相同的欄位型別"""
+    prefix = EVENT_ARCHIVE_SHEET.format(year="")
+    if sheet and sheet.startswith(prefix) and sheet[len(prefix):].isdigit():
+        return EVENT_SHEET
+    return sheet
+
+
+def get_schema(sheet: str) -> dict[str, str]:
+    """取得分頁的欄位型別，未定義的分頁只轉換編號類欄位"""
+    return SHEET_SCHEMAS.get(_schema_sheet(sheet), ID_SCHEMA)
+
+
+def get_read_dtypes(sheet: str) -> dict[str, type]:
+    """讀取時即以字串解析的欄位，供後端在解析資料時使用"""
+    return {col: str for col, kind in get_schema(sheet).items() if kind in ('string', 'category')}
+
+
+def _to_string(series: pd.Series) -> pd.Series:
+    """轉為字串，空值轉為空字串，並移除由 float 轉換而來的 ".0" 結尾"""
+    if pd.api.types.is_float_dtype(series):
+        values = series.dropna()
+        if (values % 1 == 0).all():
+            series = series.astype("Int64")
+
+    # fillna("") 確保空值轉字串後不會變成 "nan"
+    series = series.astype(object).where(series.notna(), "").astype(str)
+    is_float_str = series.str.endswith(".0")
+    if is_float_str.any():
+        series = series.where(~is_float_str, series.str[:-2])
+    return series
+
+
+def _to_category(series: pd.Series) -> pd.Series:
+    """轉為類別型別，只需清理不重複的值，不必逐列處理字串"""
+    if pd.api.types.is_float_dtype(series):
+        return _to_string(series).astype("category")
+
+    series = series.astype("category")
+    categories = series.cat.categories
+    cleaned = _to_string(pd.Series(categories, dtype=object))
+    if cleaned.is_unique:
+        series = series.cat.rename_categories(cleaned.tolist())
+    else:
+        # 清理後有重複值（例如 "1" 與 "1.0"）時改為逐列轉換
+        return _to_string(series.astype(object)).astype("category")
+
+    if series.isna().any():
+        if "" not in series.cat.categories:
+            series = series.cat.add_categories("")
+        series = series.fillna("")
+    return series
+
+
+def _parse_times(series: pd.Series) -> np.ndarray:
+    """解析時間字串為 timedelta，相同的時間只解析一次；格式錯誤或空白時視為 00:00:00"""
+    series = series.astype("category")
+    parsed = pd.to_timedelta(series.cat.categories, errors="coerce").to_numpy()
+    parsed[np.isnat(parsed)] = np.timedelta64(0, "ns")
+    # codes 為 -1（空值）時取到最後補上的 0
+    parsed = np.append(parsed, np.timedelta64(0, "ns"))
+    return parsed[series.cat.codes.to_numpy()]
+
+
+def convert_column_types(df: pd.DataFrame, sheet: str = None) -> pd.DataFrame:
+    """依分頁的欄位型別轉換資料，避免自動轉型"""
+    for col, kind in get_schema(sheet).items():
+        if col not in df.columns:
+            continue
+
+        if kind == 'string':
+            df[col] = _to_string(df[col])
+        elif kind == 'category':
+            if not isinstance(df[col].dtype, pd.CategoricalDtype):
+                df[col] = _to_category(df[col])
+        elif kind == 'int':
+            # 堂數不會超過 int32 的範圍，空值視為 0
+            df[col] = pd.to_numeric(df[col], errors="coerce").fillna(0).astype("int32")
+        elif kind == 'float':
+            df[col] = pd.to_numeric(df[col], errors="coerce").astype("float64")
+        elif kind == 'float32':
+            df[col] = pd.to_numeric(df[col], errors="coerce").astype("float32")
+        elif kind == 'date':
+            if not pd.api.types.is_datetime64_any_dtype(df[col]):
+                df[col] = pd.to_datetime(df[col], errors="coerce")
+
+    if _schema_sheet(sheet) in DATETIME_COLUMNS:
+        date_col, time_col = DATETIME_COLUMNS[_schema_sheet(sheet)]
+        if date_col in df.columns and time_col in df.columns:
+            df[date_col] = df[date_col] + _parse_times(df[time_col])
+            df.drop(columns=time_col, inplace=True)
+
+    return df
+
+
+def format_for_write(df: pd.DataFrame, sheet: str = None) -> pd.DataFrame:
+    """寫入資料庫前將日期轉回 YYYY-MM-DD 字串（合併的日期時間拆回兩欄）、類別轉回一般欄位"""
+    df = df.copy()
+
+    if _schema_sheet(sheet) in DATETIME_COLUMNS:
+        date_col, time_col = DATETIME_COLUMNS[_schema_sheet(sheet)]
+        if time_col not in df.columns and pd.api.types.is_datetime64_any_dtype(df.get(date_col)):
+            times = df[date_col].dt.strftime(TIME_FORMAT).fillna("")
+            df.insert(df.columns.get_loc(date_col) + 1, time_col, times)
+
+    for col in df.columns:
+        if pd.api.types.is_datetime64_any_dtype(df[col]):
+            df[col] = df[col].dt.strftime(DATE_FORMAT).fillna("")
+        elif isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype(object)
+        elif df[col].dtype == "float32":
+            # float32 無法精確表示小數，寫入前還原為兩位小數的金額
+            df[col] = df[col].astype("float64").round(2)
+    return df
+
+
+# 最近一次讀取的各分頁資料 {分頁: (讀取時的資料庫版本標記, DataFrame)}
+# 資料庫版本未變時直接回傳這份資料，不需重新下載整張分頁；回傳的資料與快取共用，不可直接修改
+_fresh = {}
+_fresh_lock = threading.Lock()
+
+
+def _get_fresh(sheet: str, revision: str | None) -> pd.DataFrame | None:
+    """資料庫版本與讀取時相同時回傳該分頁資料，否則回傳 None"""
+    entry = _fresh.get(sheet)
+    if revision is None or entry is None or entry[0] != revision:
+        return None
+    return entry[1]
+
+
+def _set_fresh(sheet: str, revision: str | None, df: pd.DataFrame):
+    if revision is None:
+        return
+    with _fresh_lock:
+        _fresh[sheet] = (revision, df)
+
+
+def _forget_fresh(sheet: str):
+    """本程序寫入分頁後，該分頁需重新讀取，資料庫版本也需重新查詢"""
+    with _fresh_lock:
+        _fresh.pop(sheet, None)
+    storage.forget_revision()
+
+
+def GET_DF_FROM_DB(sheet: str, refresh: bool = False):
     """
-    從 Google Sheet 讀取資料並轉換為 DataFrame
+    從資料庫（Google Sheet 或 SQLite）讀取資料並轉換為 DataFrame
+    資料庫自上次讀取後未變動時，直接回傳上次讀取的資料；refresh=True 時一律重新下載
     """
     try:
-        df = gs.read_sheet_as_df(sheet)
-        
-        # 強制轉換特定欄位為字串，避免自動轉型
-        col_types = {
-            '電話': str,
-            '匯款末五碼': str,
-            '會員編號': str,
-            '備註': str
-        }
-        
-        for col, dtype in col_types.items():
-            if col in df.columns:
-                # fillna("") 確保空值轉字串後不會變成 "nan"
-                df[col] = df[col].fillna("").astype(dtype)
-                # 針對字串欄位，移除可能的 ".0" 結尾 (源自 float 轉 str)
-                if dtype == str:
-                    df[col] = df[col].astype(str).str.replace(r'\.0$', '', regex=True)
-                
+        if refresh:
+            _forget_fresh(sheet)
+        # 版本標記需在下載前取得，下載期間若資料被修改，下次會因版本不同而重新下載
+        revision = storage.get_revision()
+        df = _get_fresh(sheet, revision)
+        if df is not None:
+            return df
+
+        df = storage.get_backend().read(sheet, dtype=get_read_dtypes(sheet))
+        df = convert_column_types(df, sheet)
+        _set_fresh(sheet, revision, df)
         return df
     except Exception as e:
         # 若是第一次讀取或連線失敗，可能需要拋出錯誤讓上層處理
         raise FileNotFoundError(f"讀取 Sheet {sheet} 失敗: {str(e)}")
 
 
-def SAVE_TO_SHEET(df: pd.DataFrame, sheet: str):
+def SAVE_TO_SHEET(df: pd.DataFrame, sheet: str, expected_rows: int = None):
     """
-    將 DataFrame 寫回 Google Sheet
+    將 DataFrame 整張寫回資料庫
+    expected_rows 為 df 所依據的資料列數，與資料庫目前列數不同時拋出 VersionConflict，避免覆寫掉其他使用者新增的資料
     """
     try:
-        gs.update_sheet(sheet_name=sheet, updated_df=df)
+        storage.get_backend().write(sheet, format_for_write(df, sheet), expected_rows=expected_rows)
         return True, "資料儲存成功！"
 
+    except storage.VersionConflict:
+        raise
     except Exception as e:
         return False, f"發生錯誤：{str(e)}"
+    finally:
+        # 寫入後（即使失敗也可能已寫入一部分）該分頁需重新讀取
+        _forget_fresh(sheet)
 
 
-def get_coach_id(coach: str, df_coach: pd.DataFrame = None) -> tuple[str, str]:
+def APPEND_TO_SHEET(df: pd.DataFrame, sheet: str, expected_rows: int = None):
+    """
+    將新增的資料列附加到資料庫，只上傳新資料
+    expected_rows 為新資料所依據的資料列數，與資料庫目前列數不同時拋出 VersionConflict
+    """
+    try:
+        if df.empty:
+            return True, "無新增資料"
+        storage.get_backend().append(sheet, format_for_write(df, sheet), expected_rows=expected_rows)
+        return True, "資料儲存成功！"
+
+    except storage.VersionConflict:
+        raise
+    except Exception as e:
+        return False, f"發生錯誤：{str(e)}"
+    finally:
+        _forget_fresh(sheet)
+
+
+def WRITE_BATCH(ops: list[storage.WriteOp]):
+    """
+    將多個分頁的附加與覆寫列合併為一次寫入（Google Sheets 為一次批次請求，SQLite 為同一個交易）
+    任一項的 expected_rows 與資料庫目前列數不同，或 expected_values 與要覆寫的資料列目前內容不同時
+    拋出 VersionConflict，所有分頁都不會寫入
+    """
+    ops = [op for op in ops if not op.df.empty]
+    try:
+        if not ops:
+            return True, "無變動資料"
+        ops = [storage.WriteOp(op.kind, op.sheet, format_for_write(op.df, op.sheet), op.expected_rows,
+                               op.expected_values) for op in ops]
+        storage.get_backend().write_batch(ops)
+        return True, "資料儲存成功！"
+
+    except storage.VersionConflict:
+        raise
+    except Exception as e:
+        return False, f"發生錯誤：{str(e)}"
+    finally:
+        for sheet in {op.sheet for op in ops}:
+            _forget_fresh(sheet)
+
+
+def get_coach_id(coach: str, df_coach: pd.DataFrame = None, lookup=None) -> tuple[str, str]:
+    # 有查詢索引時直接以 dict 查詢
+    if lookup is not None:
+        return lookup.get_coach(coach)
+
     if df_coach is None:
         df_coach = GET_DF_FROM_DB(sheet=COACH)
 
@@ -62,7 +296,13 @@ def get_coach_id(coach: str, df_coach: pd.DataFrame = None) -> tuple[str, str]:
     return coach_id, coach_str
 
 
-def get_member_name(member_id: str, df_member: pd.DataFrame = None) -> str:
+def get_member_name(member_id: str, df_member: pd.DataFrame = None, lookup=None) -> str:
+    if lookup is not None:
+        member = lookup.get_member(member_id)
+        if member is None:
+            raise InputError("查無此會員資料")
+        return member["會員姓名"]
+
     if df_member is None:
         df_member = GET_DF_FROM_DB(sheet=MEMBER_SHEET)
 
@@ -0,0 +1,127 @@
+import pandas as pd
+from mod import O_general as gr
+from mod.O_config import COACH, MEMBER_SHEET, MENU
+
+
+class LookupSnapshot:
+    """
+    每次讀取資料時建立一次的查詢索引，讓表單驗證以 dict 查詢取代重複篩選 DataFrame
+    - 會員編號 → 會員資料
+    - (會員姓名, 生日) → 會員資料列表
+    - 教練姓名 → (教練編號, 會員編號字首)
+    - (方案, 堂數) → 單堂金額
+    未傳入的分頁會在第一次使用時才從資料庫讀取，只用到會員與教練的頁面（例如新增會員）不需傳入價目表
+    """
+
+    def __init__(self, df_member: pd.DataFrame = None, df_coach: pd.DataFrame = None, df_menu: pd.DataFrame = None):
+        self._df_member = df_member
+        self._df_coach = df_coach
+        self._df_menu = df_menu
+
+        self._members = None
+        self._members_by_name = None
+        self._coaches = None
+        self._prices = None
+
+    def _build_member_index(self):
+        if self._df_member is None:
+            self._df_member = gr.GET_DF_FROM_DB(sheet=MEMBER_SHEET)
+
+        self._members = {}
+        self._members_by_name = {}
+        for row in self._df_member.to_dict("records"):
+            self._members.setdefault(row["會員編號"], []).append(row)
+            key = (row["會員姓名"], row["生日"])
+            self._members_by_name.setdefault(key, []).append(row)
+
+    def _build_coach_index(self):
+        if self._df_coach is None:
+            self._df_coach = gr.GET_DF_FROM_DB(sheet=COACH)
+
+        self._coaches = {}
+        for name, coach_id, coach_str in zip(
+                self._df_coach["姓名"], self._df_coach["教練編號"], self._df_coach["會員編號"]):
+            # 同名教練以第一筆為準
+            self._coaches.setdefault(name, (coach_id, coach_str))
+
+    def _build_price_index(self):
+        if self._df_menu is None:
+            self._df_menu = gr.GET_DF_FROM_DB(sheet=MENU)
+
+        self._prices = {}
+        for plan, count, price in zip(self._df_menu["name"], self._df_menu["count"], self._df_menu["price"]):
+            self._prices.setdefault((plan, int(count)), float(price))
+
+    def get_members(self, member_id: str) -> list[dict]:
+        """取得會員編號對應的所有會員資料（正常情況只有一筆）"""
+        if self._members is None:
+            self._build_member_index()
+        return self._members.get(member_id, [])
+
+    def get_member(self, member_id: str) -> dict | None:
+        members = self.get_members(member_id)
+        return members[0] if members else None
+
+    def find_members(self, name: str, birthday: str) -> list[dict]:
+        """以姓名及生日查詢會員"""
+        if self._members_by_name is None:
+            self._build_member_index()
+        return self._members_by_name.get((name, birthday), [])
+
+    def get_coach(self, coach: str) -> tuple[str, str]:
+        if self._coaches is None:
+            self._build_coach_index()
+        if coach not in self._coaches:
+            raise ValueError(f"查無教練資料: {coach}")
+        return self._coaches[coach]
+
+    def get_price(self, plan: str, count: int) -> float | None:
+        if self._prices is None:
+            self._build_price_index()
+        return self._prices.get((plan, int(count)))
+
+
+class MemberIndex:
+    """
+    會員選單用的索引，每個會員表版本建立一次
+    - 選項為會員編號，顯示為「會員編號 - 會員姓名」，選取後不需再從字串拆出編號
+    - 以會員編號字首、姓名或電話的部分字串搜尋會員
+    """
+
+    def __init__(self, df_member: pd.DataFrame):
+        # 選單選項不可重複，同一個會員編號以第一筆為準
+        df = df_member.drop_duplicates(subset="會員編號")
+        self._ids = df["會員編號"].fillna("").astype(str).reset_index(drop=True)
+        self._names = df["會員姓名"].fillna("").astype(str).reset_index(drop=True)
+        if "電話" in df.columns:
+            self._phones = df["電話"].fillna("").astype(str).reset_index(drop=True)
+        else:
+            self._phones = pd.Series("", index=self._ids.index)
+
+        labels = self._ids + " - " + self._names
+        self._labels = dict(zip(self._ids, labels))
+        self.ids = self._ids.tolist()
+
+    def label(self, member_id: str) -> str:
+        """會員編號對應的顯示文字，查無會員時顯示編號本身"""
+        return self._labels.get(member_id, member_id)
+
+    def search(self, query: str, keep: list[str] = None) -> list[str]:
+        """
+        搜尋會員編號（字首）、姓名或電話（部分字串），回傳符合的會員編號
+        keep 中的會員編號（例如已選取的會員）一律保留在結果最前面
+        """
+        keep = [member_id for member_id in (keep or []) if member_id in self._labels]
+        query = (query or "").strip()
+        if not query:
+            result = self.ids
+        else:
+            mask = (self._ids.str.startswith(query)
+                    | self._names.str.contains(query, case=False, regex=False)
+                    | self._phones.str.contains(query, regex=False))
+            result = self._ids[mask].tolist()
+
+        if not keep:
+            return result
+        kept = set(keep)
+        return keep + [member_id for member_id in result if member_id not in kept]
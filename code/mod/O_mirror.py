@@ -0,0 +1,109 @@
+import importlib.util
+import json
+import os
+import threading
+import pandas as pd
+from mod import O_config as config
+from mod import O_general as gr
+from mod import O_storage as storage
+from mod.O_storage import PROJECT_ROOT
+
+
+class LocalMirror:
+    """
+    各分頁的本地鏡像（Arrow IPC 檔案，讀取時以 memory map 開啟）
+    每個分頁記錄下載當時的資料庫版本標記，版本相同時才使用鏡像
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    @property
+    def _manifest_path(self):
+        return os.path.join(self.directory, "manifest.json")
+
+    def _path(self, sheet):
+        return os.path.join(self.directory, f"{sheet}.arrow")
+
+    def _read_manifest(self) -> dict:
+        try:
+            with open(self._manifest_path, encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def load(self, sheet: str, revision: str) -> pd.DataFrame | None:
+        """版本標記相同時讀取鏡像，否則回傳 None"""
+        from pyarrow import feather
+
+        if self._read_manifest().get(sheet) != revision:
+            return None
+        try:
+            return feather.read_table(self._path(sheet), memory_map=True).to_pandas()
+        except Exception:
+            return None
+
+    def save(self, sheet: str, df: pd.DataFrame, revision: str):
+        """寫入暫存檔後再取代，讀取中的鏡像不會讀到一半的檔案"""
+        import pyarrow as pa
+        from pyarrow import feather
+
+        path = self._path(sheet)
+        # 保留 index（資料列位置），不壓縮才能以 memory map 直接讀取
+        table = pa.Table.from_pandas(df, preserve_index=True)
+        feather.write_feather(table, f"{path}.tmp", compression="uncompressed")
+
+        with self._lock:
+            os.replace(f"{path}.tmp", path)
+            manifest = self._read_manifest()
+            manifest[sheet] = revision
+            with open(f"{self._manifest_path}.tmp", "w", encoding="utf-8") as f:
+                json.dump(manifest, f, ensure_ascii=False)
+            os.replace(f"{self._manifest_path}.tmp", self._manifest_path)
+
+
+_mirror = None
+_mirror_lock = threading.Lock()
+
+
+def get_mirror() -> LocalMirror | None:
+    """依 O_config.LOCAL_MIRROR 取得本地鏡像（只建立一次），未開啟或缺少 pyarrow 時回傳 None"""
+    global _mirror
+    if not config.LOCAL_MIRROR:
+        return None
+    with _mirror_lock:
+        if _mirror is None:
+            if importlib.util.find_spec("pyarrow") is None:
+                return None
+            _mirror = LocalMirror(PROJECT_ROOT / config.MIRROR_DIRECTORY)
+    return _mirror
+
+
+def get_remote_revision() -> str | None:
+    """取得資料庫目前的版本標記，短時間內重複呼叫只查詢一次"""
+    return storage.get_revision()
+
+
+def read_sheet(sheet: str, use_mirror: bool = True) -> pd.DataFrame:
+    """
+    讀取分頁：資料庫版本與鏡像相同時直接讀取本地鏡像，否則下載並更新鏡像
+    use_mirror=False 時一律下載（例如本程序已寫入過該分頁）
+    """
+    mirror = get_mirror()
+    # 版本標記需在下載前取得，下載期間若資料被修改，下次會因版本不同而重新下載
+    revision = get_remote_revision() if mirror else None
+
+    if mirror and revision and use_mirror:
+        df = mirror.load(sheet, revision)
+        if df is not None:
+            return df
+
+    df = gr.GET_DF_FROM_DB(sheet)
+    if mirror and revision:
+        try:
+            mirror.save(sheet, df, revision)
+        except Exception as e:
+            print(f"更新本地鏡像 {sheet} 失敗：{e}")
+    return df
@@ -0,0 +1,56 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# 啟動時間報告中的各階段，耗時只記錄程序啟動後的第一次
+STAGE_LABELS = {
+    "import": "匯入模組",
+    "connect": "連線資料庫",
+    "first_load": "第一次讀取資料（含連線）",
+}
+
+_timings = {}
+_reported = False
+_lock = threading.Lock()
+
+
+def record(stage: str, seconds: float):
+    """記錄啟動階段的耗時，同一階段只保留第一次"""
+    with _lock:
+        _timings.setdefault(stage, seconds)
+
+
+@contextmanager
+def measure(stage: str):
+    """量測區塊的執行時間並記錄為啟動階段"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start)
+
+
+def get_timings() -> dict:
+    """目前已記錄的各階段耗時（秒）"""
+    with _lock:
+        return dict(_timings)
+
+
+def report() -> str | None:
+    """
+    輸出啟動時間報告（整個程序只輸出一次），尚未發生的階段顯示為未執行
+    Returns:
+        報告內容，已輸出過時為 None
+    """
+    global _reported
+    with _lock:
+        if _reported:
+            return None
+        _reported = True
+        timings = dict(_timings)
+
+    parts = [f"{label} {timings[stage]:.2f} 秒" if stage in timings else f"{label} 未執行"
+             for stage, label in STAGE_LABELS.items()]
+    text = "啟動時間：" + "、".join(parts)
+    print(text)
+    return text
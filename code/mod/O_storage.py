@@ -0,0 +1,490 @@
+import sqlite3
+import threading
+import time
+from contextlib import ExitStack, closing, contextmanager
+from pathlib import Path
+import pandas as pd
+from mod import O_config as config
+from mod import O_startup as startup
+from mod.O_config import COACH, EVENT_SHEET, MAIN_SHEET, MEMBER_SHEET, MENU
+
+PROJECT_ROOT = Path(__file__).resolve().parents[2]
+
+# 各分頁在 SQLite 中建立的索引欄位
+SQLITE_INDEXES = {
+    MEMBER_SHEET: [("會員編號",), ("會員姓名", "生日")],
+    EVENT_SHEET: [("會員編號", "方案")],
+    MAIN_SHEET: [("會員編號", "方案")],
+    COACH: [("姓名",)],
+    MENU: [("name", "count")],
+}
+
+# 同一批讀取（例如啟動時同時讀取所有分頁）共用一次遠端版本查詢
+REVISION_TTL = 2
+
+
+class VersionConflict(Exception):
+    """
+    寫入時資料庫的內容與寫入所依據的版本不同（期間有其他使用者寫入）
+    列數不同，或要覆寫的資料列內容已被修改（changed_rows 為這些資料列的位置）
+    """
+
+    def __init__(self, sheet: str, expected_rows: int, actual_rows: int, changed_rows: list[int] = None):
+        if changed_rows:
+            detail = f"{len(changed_rows)} 列的內容已被修改"
+        else:
+            detail = f"預期 {expected_rows} 列，實際 {actual_rows} 列"
+        super().__init__(f"{sheet} 已被其他使用者更新（{detail}）")
+        self.sheet = sheet
+        self.expected_rows = expected_rows
+        self.actual_rows = actual_rows
+        self.changed_rows = changed_rows or []
+
+
+def check_version(sheet: str, expected_rows: int | None, actual_rows: int):
+    """expected_rows 為 None 時不檢查"""
+    if expected_rows is not None and expected_rows != actual_rows:
+        raise VersionConflict(sheet, expected_rows, actual_rows)
+
+
+def same_value(expected, actual) -> bool:
+    """
+    比較寫入所依據的值與資料庫目前的值
+    數字以兩位小數比較（試算表與 SQLite 讀回的型別可能不同，例如 "101" 與 101），空值與空字串視為相同
+    """
+    expected = "" if expected is None or pd.isna(expected) else expected
+    actual = "" if actual is None or pd.isna(actual) else actual
+    try:
+        return abs(float(str(expected).replace(",", "")) - float(str(actual).replace(",", ""))) < 0.005
+    except ValueError:
+        return str(expected).strip() == str(actual).strip()
+
+
+def check_rows(sheet: str, expected_values: pd.DataFrame | None, actual_rows: dict, row_count: int):
+    """
+    確認要覆寫的資料列目前的內容與寫入所依據的內容相同，作為覆寫資料列的版本
+    expected_values 的 index 為資料列位置；actual_rows 為 {資料列位置: {欄位: 值}}
+    """
+    if expected_values is None:
+        return
+    changed = [
+        position for position, values in zip(expected_values.index, expected_values.itertuples(index=False))
+        if position not in actual_rows
+        or not all(same_value(value, actual_rows[position].get(col))
+                   for col, value in zip(expected_values.columns, values))
+    ]
+    if changed:
+        raise VersionConflict(sheet, row_count, row_count, changed_rows=changed)
+
+
+class WriteOp:
+    """
+    批次寫入中的一項寫入
+    kind 為 "append"（附加在表的最後）或 "update_rows"（以 df 覆寫 index 所指的資料列）
+    expected_values 為 update_rows 要覆寫的資料列在寫入前的內容（可只含部分欄位），
+    與資料庫目前的內容不同時拋出 VersionConflict；只檢查列數無法發現同一列被其他使用者覆寫
+    """
+
+    def __init__(self, kind: str, sheet: str, df: pd.DataFrame, expected_rows: int = None,
+                 expected_values: pd.DataFrame = None):
+        if kind not in ("append", "update_rows"):
+            raise ValueError(f"不支援的寫入類型: {kind}")
+        self.kind = kind
+        self.sheet = sheet
+        self.df = df
+        self.expected_rows = expected_rows
+        self.expected_values = expected_values
+
+
+class StorageBackend:
+    """
+    儲存後端介面，每個分頁視為一張表
+    資料列位置（DataFrame 的 index）從 0 開始，代表標題下的第一列
+    寫入時可傳入 expected_rows（寫入所依據的資料列數），與資料庫目前列數不同時拋出 VersionConflict
+    """
+
+    def read(self, sheet: str, dtype: dict = None) -> pd.DataFrame:
+        """dtype 為解析時即指定型別的欄位（例如編號以字串讀取）"""
+        raise NotImplementedError
+
+    def exists(self, sheet: str) -> bool:
+        raise NotImplementedError
+
+    def row_count(self, sheet: str) -> int:
+        """分頁目前的資料列數（不含標題），分頁不存在時為 0"""
+        raise NotImplementedError
+
+    def tail(self, sheet: str, expected_rows: int = None) -> tuple[int, object]:
+        """
+        分頁目前的資料列數與最後一列第一欄的值（不下載整張表），沒有資料列時為 (0, None)
+        expected_rows 為預期的列數，後端可只讀取其後的部分
+        """
+        raise NotImplementedError
+
+    def revision(self) -> str | None:
+        """整個資料庫的版本標記（任何分頁異動後即改變），無法取得時回傳 None"""
+        return None
+
+    def write(self, sheet: str, df: pd.DataFrame, expected_rows: int = None):
+        """以 df 覆寫整張表"""
+        raise NotImplementedError
+
+    def append(self, sheet: str, df: pd.DataFrame, expected_rows: int = None):
+        """將 df 附加在表的最後"""
+        raise NotImplementedError
+
+    def update_rows(self, sheet: str, rows_df: pd.DataFrame, columns: list[str], expected_rows: int = None,
+                    expected_values: pd.DataFrame = None):
+        """以 rows_df 覆寫 index 所指的資料列，expected_values 為這些資料列寫入前的內容"""
+        raise NotImplementedError
+
+    def write_batch(self, ops: list[WriteOp]):
+        """一次送出多個分頁的寫入，預設逐一寫入"""
+        for op in ops:
+            if op.kind == "append":
+                self.append(op.sheet, op.df, expected_rows=op.expected_rows)
+            else:
+                self.update_rows(op.sheet, op.df, list(op.df.columns), expected_rows=op.expected_rows,
+                                 expected_values=op.expected_values)
+
+
+class GSheetBackend(StorageBackend):
+    """
+    Google Sheets 後端（預設）
+    Sheets API 沒有條件式寫入，版本檢查與寫入之間以各分頁的鎖避免本程序內的其他寫入插入
+    """
+
+    def __init__(self):
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+
+    @contextmanager
+    def _locked(self, sheets):
+        """依固定順序取得多個分頁的鎖，避免互相等待"""
+        with self._locks_guard:
+            locks = [self._locks.setdefault(sheet, threading.Lock()) for sheet in sorted(set(sheets))]
+        with ExitStack() as stack:
+            for lock in locks:
+                stack.enter_context(lock)
+            yield
+
+    @contextmanager
+    def _checked(self, sheet, expected_rows):
+        """持有分頁的鎖並確認版本後才寫入（以預期的列數作為讀取第一欄的起點）"""
+        from mod import O_connect_to_gsheet as gs
+        with self._locked([sheet]):
+            if expected_rows is not None:
+                check_version(sheet, expected_rows, gs.count_rows(sheet, row_count=expected_rows))
+            yield
+
+    def read(self, sheet, dtype=None):
+        from mod import O_connect_to_gsheet as gs
+        return gs.read_sheet_as_df(sheet, dtype=dtype)
+
+    def revision(self):
+        from mod import O_connect_to_gsheet as gs
+        return gs.get_revision()
+
+    def row_count(self, sheet):
+        from mod import O_connect_to_gsheet as gs
+        return gs.count_rows(sheet)
+
+    def tail(self, sheet, expected_rows=None):
+        from mod import O_connect_to_gsheet as gs
+        return gs.get_tail(sheet, row_count=expected_rows)
+
+    def exists(self, sheet):
+        from gspread.exceptions import WorksheetNotFound
+        from mod import O_connect_to_gsheet as gs
+        try:
+            gs.get_worksheet(sheet)
+            return True
+        except WorksheetNotFound:
+            return False
+
+    def write(self, sheet, df, expected_rows=None):
+        from mod import O_connect_to_gsheet as gs
+        with self._checked(sheet, expected_rows):
+            gs.update_sheet(sheet_name=sheet, updated_df=df)
+
+    def append(self, sheet, df, expected_rows=None):
+        from mod import O_connect_to_gsheet as gs
+        with self._checked(sheet, expected_rows):
+            gs.append_rows(sheet_name=sheet, new_df=df)
+
+    def update_rows(self, sheet, rows_df, columns, expected_rows=None, expected_values=None):
+        from mod import O_connect_to_gsheet as gs
+        if expected_values is not None:
+            self.write_batch([WriteOp("update_rows", sheet, rows_df[columns], expected_rows, expected_values)])
+            return
+        with self._checked(sheet, expected_rows):
+            gs.update_rows(sheet_name=sheet, rows_df=rows_df, columns=columns)
+
+    def write_batch(self, ops):
+        # 一次讀取各分頁的標題列、列數與要覆寫的資料列（確認版本、決定附加位置），再以一次請求寫入所有分頁
+        from mod import O_connect_to_gsheet as gs
+        sheets = list(dict.fromkeys(op.sheet for op in ops))
+        rows = {}
+        for op in ops:
+            if op.expected_values is not None:
+                rows.setdefault(op.sheet, []).extend(int(p) for p in op.expected_values.index)
+        # 以寫入所依據的列數作為讀取第一欄的起點，只需讀取預期的最後一列之後的部分
+        row_counts = {op.sheet: op.expected_rows for op in ops if op.expected_rows is not None}
+        with self._locked(sheets):
+            layout = gs.get_layout(sheets, rows=rows, row_counts=row_counts)
+            for op in ops:
+                header, row_count, row_contents = layout[op.sheet]
+                check_version(op.sheet, op.expected_rows, row_count)
+                check_rows(op.sheet, op.expected_values, row_contents, row_count)
+
+            data = []
+            for op in ops:
+                header, row_count, row_contents = layout[op.sheet]
+                if op.kind == "append":
+                    data.extend(gs.append_values(op.sheet, op.df, header, row_count))
+                    # 同一批中再附加到同一分頁時接在這次的資料之後
+                    layout[op.sheet] = (header or list(op.df.columns), row_count + len(op.df), row_contents)
+                else:
+                    data.extend(gs.row_values(op.df, list(op.df.columns), sheet_name=op.sheet))
+            gs.batch_update_values(data)
+            for sheet in sheets:
+                gs.remember_row_count(sheet, layout[sheet][1])
+
+
+def _quote(name: str) -> str:
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def _sql_type(dtype) -> str:
+    if pd.api.types.is_bool_dtype(dtype) or pd.api.types.is_integer_dtype(dtype):
+        return "INTEGER"
+    if pd.api.types.is_float_dtype(dtype):
+        return "REAL"
+    return "TEXT"
+
+
+def _to_sql_value(value):
+    if pd.isna(value):
+        return None
+    if isinstance(value, pd.Timestamp):
+        return value.isoformat()
+    if hasattr(value, "item"):
+        return value.item()
+    return value
+
+
+class SQLiteBackend(StorageBackend):
+    """
+    本地 SQLite 後端，可取代 Google Sheets 執行，亦可作為測試用的本地資料庫
+    資料列位置對應 rowid - 1（表只會整張覆寫或附加，不會刪除單列）
+    """
+
+    def __init__(self, db_path):
+        self.db_path = Path(db_path)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        """寫入交易：全部成功才 commit，任何錯誤都 rollback"""
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def _table_exists(self, conn, sheet):
+        row = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (sheet,)).fetchone()
+        return row is not None
+
+    def _row_count(self, conn, sheet):
+        if not self._table_exists(conn, sheet):
+            return 0
+        return conn.execute(f"SELECT COUNT(*) FROM {_quote(sheet)}").fetchone()[0]
+
+    def _table_columns(self, conn, sheet):
+        return [row[1] for row in conn.execute(f"PRAGMA table_info({_quote(sheet)})")]
+
+    def _insert(self, conn, sheet, df, columns):
+        placeholders = ", ".join("?" for _ in columns)
+        col_sql = ", ".join(_quote(col) for col in columns)
+        rows = [[_to_sql_value(v) for v in row] for row in df.reindex(columns=columns).itertuples(index=False)]
+        conn.executemany(f"INSERT INTO {_quote(sheet)} ({col_sql}) VALUES ({placeholders})", rows)
+
+    def _create_table(self, conn, sheet, df):
+        col_sql = ", ".join(f"{_quote(col)} {_sql_type(dtype)}" for col, dtype in df.dtypes.items())
+        conn.execute(f"DROP TABLE IF EXISTS {_quote(sheet)}")
+        conn.execute(f"CREATE TABLE {_quote(sheet)} ({col_sql})")
+
+        for cols in SQLITE_INDEXES.get(sheet, []):
+            if not set(cols).issubset(df.columns):
+                continue
+            index_name = _quote(f"idx_{sheet}_{'_'.join(cols)}")
+            conn.execute(f"CREATE INDEX {index_name} ON {_quote(sheet)} ({', '.join(_quote(c) for c in cols)})")
+
+    def revision(self):
+        # WAL 模式下寫入會先進入 -wal 檔，兩個檔案的修改時間與大小一起作為版本標記
+        parts = []
+        for path in (self.db_path, Path(f"{self.db_path}-wal")):
+            if path.exists():
+                stat = path.stat()
+                parts.append(f"{stat.st_mtime_ns}:{stat.st_size}")
+        return "|".join(parts) or None
+
+    def exists(self, sheet):
+        with closing(self._connect()) as conn:
+            return self._table_exists(conn, sheet)
+
+    def row_count(self, sheet):
+        with closing(self._connect()) as conn:
+            return self._row_count(conn, sheet)
+
+    def tail(self, sheet, expected_rows=None):
+        with closing(self._connect()) as conn:
+            if not self._table_exists(conn, sheet):
+                return 0, None
+            row = conn.execute(f"SELECT * FROM {_quote(sheet)} ORDER BY rowid DESC LIMIT 1").fetchone()
+            return self._row_count(conn, sheet), (row[0] if row else None)
+
+    def read(self, sheet, dtype=None):
+        # SQLite 已保存欄位型別，不需在解析時指定
+        with closing(self._connect()) as conn:
+            if not self._table_exists(conn, sheet):
+                raise FileNotFoundError(f"SQLite 中不存在資料表 {sheet}")
+            df = pd.read_sql_query(f"SELECT rowid AS _rowid, * FROM {_quote(sheet)} ORDER BY rowid", conn)
+
+        df.index = df.pop("_rowid") - 1
+        df.index.name = None
+        return df
+
+    # 版本檢查與寫入在同一個 IMMEDIATE 交易中，其他程序無法在兩者之間寫入
+    def write(self, sheet, df, expected_rows=None):
+        with self._transaction() as conn:
+            check_version(sheet, expected_rows, self._row_count(conn, sheet))
+            self._create_table(conn, sheet, df)
+            self._insert(conn, sheet, df, list(df.columns))
+
+    def append(self, sheet, df, expected_rows=None):
+        with self._transaction() as conn:
+            self._append(conn, sheet, df, expected_rows)
+
+    def _append(self, conn, sheet, df, expected_rows):
+        check_version(sheet, expected_rows, self._row_count(conn, sheet))
+        if not self._table_exists(conn, sheet):
+            self._create_table(conn, sheet, df)
+        columns = self._table_columns(conn, sheet)
+
+        # 新資料若有表中沒有的欄位，先補上欄位
+        for col in df.columns:
+            if col not in columns:
+                conn.execute(f"ALTER TABLE {_quote(sheet)} ADD COLUMN {_quote(col)} {_sql_type(df[col].dtype)}")
+                columns.append(col)
+
+        self._insert(conn, sheet, df, columns)
+
+    def update_rows(self, sheet, rows_df, columns, expected_rows=None, expected_values=None):
+        with self._transaction() as conn:
+            self._update_rows(conn, sheet, rows_df, columns, expected_rows, expected_values)
+
+    def _current_rows(self, conn, sheet, positions, columns) -> dict:
+        """讀取指定資料列目前的內容 {資料列位置: {欄位: 值}}"""
+        if not positions or not self._table_exists(conn, sheet):
+            return {}
+        col_sql = ", ".join(_quote(col) for col in columns)
+        placeholders = ", ".join("?" for _ in positions)
+        result = conn.execute(
+            f"SELECT rowid, {col_sql} FROM {_quote(sheet)} WHERE rowid IN ({placeholders})",
+            [int(p) + 1 for p in positions]).fetchall()
+        return {row[0] - 1: dict(zip(columns, row[1:])) for row in result}
+
+    def _update_rows(self, conn, sheet, rows_df, columns, expected_rows, expected_values=None):
+        set_sql = ", ".join(f"{_quote(col)} = ?" for col in columns)
+        rows = [
+            [_to_sql_value(v) for v in values] + [int(position) + 1]
+            for position, values in zip(rows_df.index, rows_df[columns].itertuples(index=False))
+        ]
+        row_count = self._row_count(conn, sheet)
+        check_version(sheet, expected_rows, row_count)
+        if expected_values is not None:
+            current = self._current_rows(conn, sheet, list(expected_values.index), list(expected_values.columns))
+            check_rows(sheet, expected_values, current, row_count)
+        conn.executemany(f"UPDATE {_quote(sheet)} SET {set_sql} WHERE rowid = ?", rows)
+
+    def write_batch(self, ops):
+        # 所有寫入在同一個交易中，任一分頁版本不符或寫入失敗時全部 rollback
+        with self._transaction() as conn:
+            for op in ops:
+                if op.kind == "append":
+                    self._append(conn, op.sheet, op.df, op.expected_rows)
+                else:
+                    self._update_rows(conn, op.sheet, op.df, list(op.df.columns), op.expected_rows,
+                                      op.expected_values)
+
+    def import_excel(self, xlsx_path):
+        """將 xlsx 資料庫的所有分頁匯入 SQLite（例如專案內的 member_database.xlsx）"""
+        all_sheets = pd.read_excel(xlsx_path, sheet_name=None)
+        for sheet, df in all_sheets.items():
+            self.write(sheet, df)
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend() -> StorageBackend:
+    """依 O_config.STORAGE_BACKEND 取得儲存後端（只建立一次）"""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            if config.STORAGE_BACKEND == "sqlite":
+                with startup.measure("connect"):
+                    _backend = SQLiteBackend(PROJECT_ROOT / config.SQLITE_DATABASE)
+                    # 第一次使用時以專案內的 xlsx 資料庫建立初始資料
+                    if not _backend.db_path.exists():
+                        _backend.import_excel(PROJECT_ROOT / config.DATABASE)
+            elif config.STORAGE_BACKEND == "gsheet":
+                # 試算表連線在第一次讀寫時才建立（O_connect_to_gsheet.conn_to_gsheets）
+                _backend = GSheetBackend()
+            else:
+                raise ValueError(f"不支援的儲存後端: {config.STORAGE_BACKEND}")
+    return _backend
+
+
+def set_backend(backend: StorageBackend):
+    """指定儲存後端（例如測試時改用暫存的 SQLite 檔案）"""
+    global _backend
+    with _backend_lock:
+        _backend = backend
+
+
+_revision = (0, None)
+_revision_lock = threading.Lock()
+
+
+def get_revision() -> str | None:
+    """取得資料庫目前的版本標記，短時間內重複呼叫只查詢一次，無法取得時回傳 None"""
+    global _revision
+    with _revision_lock:
+        checked_at, revision = _revision
+        if revision is None or time.monotonic() - checked_at > REVISION_TTL:
+            try:
+                revision = get_backend().revision()
+            except Exception as e:
+                print(f"取得資料庫版本失敗：{e}")
+                revision = None
+            _revision = (time.monotonic(), revision)
+        return revision
+
+
+def forget_revision():
+    """本程序寫入資料庫後呼叫，下次取得版本標記時重新查詢"""
+    global _revision
+    with _revision_lock:
+        _revision = (0, None)
@@ -0,0 +1,263 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+import pandas as pd
+from mod import D_main_table as mt
+from mod import O_cache as cache
+from mod import O_general as gr
+from mod import O_storage as storage
+from mod.O_config import EVENT_SHEET, MAIN_SHEET, MEMBER_SHEET, WRITE_RETRIES
+
+# 收到第一筆交易後再等待的秒數，期間送出的交易合併為一次寫入
+BATCH_WINDOW = 0.05
+MAX_BATCH = 50
+
+
+class _EventTransaction:
+    """一次交易紀錄寫入：附加到 B_event 並更新 A_main"""
+
+    def __init__(self, df_new, df_event, df_member, rebuild):
+        self.df_new = df_new
+        self.df_event = df_event
+        self.df_member = df_member
+        self.rebuild = rebuild
+        # 重新檢查後資料已不成立（例如剩餘堂數不足），與寫入失敗不同，重試也不會成功
+        self.rejected = False
+        self.future = Future()
+
+
+class _Call:
+    """其他寫入（例如新增會員、手動更新），依送出順序單獨執行"""
+
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+
+
+def get_current(sheet: str, fallback: pd.DataFrame = None) -> pd.DataFrame | None:
+    """取得快取中最新版本的資料，本程序尚未寫入過該分頁時使用呼叫端傳入的資料"""
+    df = cache.get_published(sheet, cache.get_version(sheet))
+    return df if df is not None else fallback
+
+
+class TransactionCoordinator:
+    """
+    整個程序共用的單一寫入者：所有寫入依序由同一個執行緒執行，不會互相穿插
+    - 交易紀錄的附加與主表更新視為同一筆交易，以一次批次寫入送出；寫入失敗時以完整重算修復主表
+    - 短時間內連續送出的交易紀錄合併為同一次批次寫入
+    - 每筆交易寫入前依最新的交易紀錄（含同一批中排在前面的交易）重新檢查，避免重複扣堂
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._worker = None
+        self._worker_lock = threading.Lock()
+        self._needs_repair = False
+
+    def _ensure_worker(self):
+        with self._worker_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="transaction-coordinator", daemon=True)
+                self._worker.start()
+
+    def submit_events(self, df_new: pd.DataFrame, df_event: pd.DataFrame = None, df_member: pd.DataFrame = None,
+                      rebuild=None) -> tuple[bool, str, pd.DataFrame]:
+        """
+        送出交易紀錄並等待寫入完成（交易紀錄與主表一起寫入）
+        rebuild(df_event) 依最新的交易紀錄重新產生要寫入的資料，資料已不成立時拋出 InputError
+        Returns:
+            (success: 是否寫入, message: 訊息, df_new: 實際寫入的資料列)
+        """
+        tx = _EventTransaction(df_new, df_event, df_member, rebuild)
+        self._queue.put(tx)
+        self._ensure_worker()
+        return tx.future.result()
+
+    def submit_event_batch(self, transactions: list[tuple]) -> list[tuple[str, str]]:
+        """
+        一次送出多筆交易紀錄並等待寫入完成（例如寫入佇列中的項目），各筆依序重新檢查後合併寫入
+        transactions 為 [(df_new, rebuild)]，rebuild 與 submit_events 相同，可為 None
+        Returns:
+            每筆交易的 (狀態, 訊息)，狀態為 "accepted"（已寫入）、"rejected"（重新檢查後已不成立）
+            或 "failed"（寫入失敗，可重試）
+        """
+        txs = [_EventTransaction(df_new, None, None, rebuild) for df_new, rebuild in transactions]
+        for tx in txs:
+            self._queue.put(tx)
+        self._ensure_worker()
+
+        results = []
+        for tx in txs:
+            success, msg, _ = tx.future.result()
+            if success:
+                results.append(("accepted", msg))
+            else:
+                results.append(("rejected" if tx.rejected else "failed", msg))
+        return results
+
+    def run(self, func, *args, **kwargs):
+        """在寫入執行緒中執行 func 並回傳結果，與其他寫入依序執行"""
+        if threading.current_thread() is self._worker:
+            return func(*args, **kwargs)
+        call = _Call(func, args, kwargs)
+        self._queue.put(call)
+        self._ensure_worker()
+        return call.future.result()
+
+    def _collect(self) -> list:
+        """取出第一筆寫入後，再收集 BATCH_WINDOW 內送出的寫入"""
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + BATCH_WINDOW
+        while len(batch) < MAX_BATCH:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+
+            # 依送出順序執行：連續的交易紀錄合併處理，其他寫入各自執行
+            events = []
+            for item in batch:
+                if isinstance(item, _EventTransaction):
+                    events.append(item)
+                    continue
+                if events:
+                    self._commit_events(events)
+                    events = []
+                self._call(item)
+            if events:
+                self._commit_events(events)
+
+    def _call(self, call: _Call):
+        try:
+            call.future.set_result(call.func(*call.args, **call.kwargs))
+        except Exception as e:
+            call.future.set_exception(e)
+
+    def _commit_events(self, batch: list[_EventTransaction]):
+        try:
+            self._write_events(batch)
+        except Exception as e:
+            for tx in batch:
+                if not tx.future.done():
+                    tx.future.set_result((False, f"系統錯誤：{str(e)}", tx.df_new))
+
+    def _write_events(self, batch: list[_EventTransaction]):
+        # 先前的寫入失敗且主表尚未修復時，先修復主表
+        if self._needs_repair:
+            self._repair()
+
+        df_event = get_current(EVENT_SHEET, batch[0].df_event)
+        # 最新版本主表的結餘引擎：只套用新交易的差額，不需重建或複製整張主表
+        engine = cache.get_main_engine()
+        df_member = get_current(MEMBER_SHEET, next((tx.df_member for tx in batch if tx.df_member is not None), None))
+        accepted = {}
+        rejected = {}
+
+        def prepare(df_ledger: pd.DataFrame) -> pd.DataFrame:
+            """依序重新檢查各筆交易，排在後面的交易會將前面已接受的資料列一起納入檢查"""
+            accepted.clear()
+            rejected.clear()
+            for tx in batch:
+                if tx.rebuild is None:
+                    accepted[tx] = tx.df_new
+                    continue
+                if accepted:
+                    df_earlier = [gr.convert_column_types(df.copy(), EVENT_SHEET) for df in accepted.values()]
+                    df_ledger_now = pd.concat([df_ledger, *df_earlier])
+                else:
+                    df_ledger_now = df_ledger
+                try:
+                    accepted[tx] = tx.rebuild(df_ledger_now)
+                except gr.InputError as e:
+                    rejected[tx] = str(e)
+            return pd.concat(list(accepted.values()), ignore_index=True) if accepted else None
+
+        if df_event is None:
+            df_event = gr.GET_DF_FROM_DB(sheet=EVENT_SHEET)
+
+        # 交易紀錄的附加與主表的變動合併為一次寫入；任一分頁版本不符時兩者皆不寫入，重新讀取該分頁後再試
+        success, msg = False, ""
+        for attempt in range(WRITE_RETRIES + 1):
+            df_new = prepare(df_event)
+            if df_new is None:
+                break
+            if engine is None:
+                engine = mt.BalanceEngine(gr.GET_DF_FROM_DB(sheet=MAIN_SHEET, refresh=attempt > 0))
+            df_updated, df_added = mt.get_main_changes(df_new, engine, df_member=df_member)
+            ops = [storage.WriteOp("append", EVENT_SHEET, df_new, expected_rows=len(df_event)),
+                   *mt.main_write_ops(engine, df_updated, df_added)]
+
+            try:
+                success, msg = gr.WRITE_BATCH(ops)
+            except storage.VersionConflict as e:
+                msg = f"資料寫入衝突，請重新操作：{str(e)}"
+                # 其他使用者寫入交易紀錄時也一併更新了主表的結餘（覆寫不改變列數），兩張表都要重新讀取
+                if e.sheet == EVENT_SHEET:
+                    df_event = gr.GET_DF_FROM_DB(sheet=EVENT_SHEET, refresh=True)
+                engine = None
+                continue
+
+            if success:
+                # 將新紀錄併入快取中的交易紀錄與主表，不需重新讀取
+                cache.patch_append(EVENT_SHEET, df_event, df_new)
+                engine.commit(df_updated, df_added)
+                cache.publish_main_engine(engine)
+                self._refresh_checkpoint()
+            else:
+                # 遠端可能只寫入一部分，重新讀取兩張表，並在下一批寫入前以完整重算修復主表
+                cache.invalidate([EVENT_SHEET, MAIN_SHEET])
+                self._needs_repair = True
+            break
+
+        for tx in batch:
+            if tx in rejected:
+                tx.rejected = True
+                tx.future.set_result((False, f"資料已被其他使用者更新：\n{rejected[tx]}", tx.df_new))
+            elif success:
+                tx.future.set_result((True, msg, accepted[tx]))
+            else:
+                tx.future.set_result((False, msg, tx.df_new))
+
+    def _refresh_checkpoint(self):
+        """以剛寫入成功的交易紀錄更新結餘檢查點，失敗不影響已完成的寫入"""
+        try:
+            df_event = get_current(EVENT_SHEET)
+            if df_event is not None:
+                mt.refresh_checkpoint(df_event)
+        except Exception as e:
+            print(f"更新結餘檢查點失敗：{e}")
+
+    def _repair(self) -> bool:
+        """以完整重算覆寫主表，成功後清除待修復標記"""
+        success, msg = mt.D_update_main_data(df_event=get_current(EVENT_SHEET), df_member=get_current(MEMBER_SHEET),
+                                             write_checkpoint=False)
+        cache.invalidate([MAIN_SHEET])
+        if success:
+            self._needs_repair = False
+        else:
+            print(f"修復主表失敗：{msg}")
+        return success
+
+
+_coordinator = None
+_coordinator_lock = threading.Lock()
+
+
+def get_coordinator() -> TransactionCoordinator:
+    """取得整個程序共用的寫入協調器（只建立一次）"""
+    global _coordinator
+    with _coordinator_lock:
+        if _coordinator is None:
+            _coordinator = TransactionCoordinator()
+    return _coordinator
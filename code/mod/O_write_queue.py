@@ -0,0 +1,259 @@
+import json
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from datetime import datetime
+import pandas as pd
+from mod import C_consume
+from mod import F_refund
+from mod import O_cache as cache
+from mod import O_general as gr
+from mod import O_transaction as txn
+from mod.O_config import MEMBER_SHEET
+
+# 會寫入 B_event 的操作，連續的同類操作會合併成一次寫入
+EVENT_ACTIONS = {"purchase", "customized_purchase", "consume", "refund"}
+MEMBER_ACTIONS = {"add_member"}
+
+
+def _json_default(value):
+    """將 numpy 型別轉為 json 可儲存的原生型別"""
+    if hasattr(value, "item"):
+        return value.item()
+    return str(value)
+
+
+def to_records(action: str, data: dict) -> list[dict]:
+    """將確認畫面的資料轉為要寫入的資料列"""
+    if "batch_list" in data:
+        return list(data["batch_list"])
+
+    # 移除僅供顯示用的欄位
+    record = {k: v for k, v in data.items() if not k.startswith("顯示_")}
+    return [record]
+
+
+def get_rebuild(action: str, records: list[dict]):
+    """
+    佇列項目寫入前的重新檢查，與即時寫入相同：扣堂與退款依最新的交易紀錄（含同一批中排在前面的項目）重新計算
+    資料已不成立時拋出 InputError；購買課程不需檢查，回傳 None
+    """
+    if action == "consume":
+        df_records = pd.DataFrame(records)
+
+        def rebuild(df_latest):
+            df = C_consume.recheck_consume(df_records, df_latest)
+            # 保留送出時的交易日期與時間，不以同步的時間記錄
+            return df.assign(交易日期=records[0]["交易日期"], 交易時間=records[0]["交易時間"])
+        return rebuild
+
+    if action == "refund":
+        return lambda df_latest: F_refund.recheck_refund(records[0], df_latest)
+
+    return None
+
+
+def _append_members(df_new: pd.DataFrame, action: str) -> tuple[bool, str]:
+    """附加佇列中的新會員（在寫入協調器的執行緒中執行）"""
+    success, msg = gr.APPEND_TO_SHEET(df=df_new, sheet=MEMBER_SHEET)
+    if success:
+        cache.invalidate_action(action)
+    return success, msg
+
+
+class WriteBehindQueue:
+    """
+    本地寫入佇列（SQLite outbox）
+    交易送出時只寫入本地佇列即回覆成功，再由背景執行緒分批同步到資料庫，
+    同步失敗會保留在佇列中並以遞增的間隔重試，不會阻塞櫃台操作
+    """
+
+    def __init__(self, db_path, flush_interval=2, max_batch=50, max_backoff=60):
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.max_backoff = max_backoff
+
+        self._wakeup = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._worker = None
+        self._stop = False
+
+        with closing(self._connect()) as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    action TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    last_error TEXT,
+                    created_at TEXT NOT NULL
+                )
+            """)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def submit(self, action: str, data: dict) -> tuple[bool, str]:
+        """將交易寫入本地佇列，寫入後立即回覆"""
+        try:
+            records = to_records(action, data)
+            payload = json.dumps(records, ensure_ascii=False, default=_json_default)
+            created_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+            with closing(self._connect()) as conn:
+                conn.execute(
+                    "INSERT INTO outbox (action, payload, created_at) VALUES (?, ?, ?)",
+                    (action, payload, created_at))
+
+            self._wakeup.set()
+            return True, f"已記錄 {len(records)} 筆資料，將於背景同步至資料庫"
+
+        except Exception as e:
+            return False, f"寫入佇列失敗：{str(e)}"
+
+    def pending_count(self) -> int:
+        with closing(self._connect()) as conn:
+            return conn.execute("SELECT COUNT(*) FROM outbox WHERE status = 'pending'").fetchone()[0]
+
+    def rejected_items(self) -> list[dict]:
+        """同步時重新檢查已不成立、未寫入資料庫的項目（例如剩餘堂數已不足），需告知使用者"""
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT id, action, payload, last_error, created_at FROM outbox WHERE status = 'rejected' ORDER BY id"
+            ).fetchall()
+        return [{"id": row[0], "action": row[1], "records": json.loads(row[2]), "error": row[3], "created_at": row[4]}
+                for row in rows]
+
+    def dismiss_rejected(self, ids: list[int]):
+        """使用者確認後移除未寫入的項目"""
+        if not ids:
+            return
+        with closing(self._connect()) as conn:
+            conn.execute(
+                f"DELETE FROM outbox WHERE status = 'rejected' AND id IN ({','.join('?' for _ in ids)})", ids)
+
+    def _fetch_batch(self, conn) -> list[tuple]:
+        """取出最前面一段連續、可合併寫入的佇列項目"""
+        rows = conn.execute(
+            "SELECT id, action, payload, status, attempts FROM outbox WHERE status = 'pending' ORDER BY id LIMIT ?",
+            (self.max_batch,)).fetchall()
+        if not rows:
+            return []
+
+        def kind(action):
+            return "event" if action in EVENT_ACTIONS else action
+
+        # 依序合併同類的操作，遇到不同的就停止，確保寫入順序不變
+        first_kind = kind(rows[0][1])
+        batch = []
+        for row in rows:
+            if kind(row[1]) != first_kind:
+                break
+            batch.append(row)
+        return batch
+
+    def _write_batch(self, conn, batch) -> int:
+        """
+        將一段佇列項目交由寫入協調器寫入，佇列只負責讀取與刪除本地項目，與櫃台的即時寫入依序執行
+        Returns:
+            重新檢查後已不成立、未寫入的項目數
+        """
+        ids = [row[0] for row in batch]
+        action = batch[0][1]
+        id_sql = ",".join("?" for _ in ids)
+
+        if action in MEMBER_ACTIONS:
+            df_new = pd.DataFrame([record for row in batch for record in json.loads(row[2])])
+            success, msg = txn.get_coordinator().run(_append_members, df_new, action)
+            if not success:
+                raise RuntimeError(msg)
+            conn.execute(f"DELETE FROM outbox WHERE id IN ({id_sql})", ids)
+            return 0
+
+        if action not in EVENT_ACTIONS:
+            raise ValueError(f"未知的操作類型: {action}")
+
+        # 每個項目各自依最新的交易紀錄重新檢查（同一批中排在前面的項目也納入），再由協調器合併為一次寫入
+        transactions = []
+        for _, row_action, payload, _, _ in batch:
+            records = json.loads(payload)
+            transactions.append((pd.DataFrame(records), get_rebuild(row_action, records)))
+        results = txn.get_coordinator().submit_event_batch(transactions)
+
+        rejected = 0
+        errors = []
+        for row_id, (status, msg) in zip(ids, results):
+            if status == "accepted":
+                conn.execute("DELETE FROM outbox WHERE id = ?", (row_id,))
+            elif status == "rejected":
+                conn.execute("UPDATE outbox SET status = 'rejected', last_error = ? WHERE id = ?", (msg, row_id))
+                rejected += 1
+            else:
+                errors.append(msg)
+
+        # 寫入失敗的項目保留在佇列中，下次重試
+        if errors:
+            raise RuntimeError(errors[0])
+        return rejected
+
+    def flush(self) -> tuple[bool, str]:
+        """將佇列中的資料依序同步到資料庫，直到佇列清空或發生錯誤"""
+        with self._flush_lock, closing(self._connect()) as conn:
+            count = 0
+            rejected = 0
+            while True:
+                batch = self._fetch_batch(conn)
+                if not batch:
+                    msg = f"已同步 {count} 筆佇列資料"
+                    if rejected:
+                        msg += f"，{rejected} 筆因資料已變動未寫入"
+                    return True, msg
+
+                try:
+                    batch_rejected = self._write_batch(conn, batch)
+                    count += len(batch) - batch_rejected
+                    rejected += batch_rejected
+                except Exception as e:
+                    # 已寫入（已刪除）或已標記為不成立的項目不受影響
+                    ids = [row[0] for row in batch]
+                    conn.execute(
+                        f"UPDATE outbox SET attempts = attempts + 1, last_error = ? "
+                        f"WHERE status = 'pending' AND id IN ({','.join('?' for _ in ids)})",
+                        [str(e), *ids])
+                    return False, f"同步失敗：{str(e)}"
+
+    def _run(self):
+        failures = 0
+        while not self._stop:
+            self._wakeup.wait(timeout=self.flush_interval)
+            self._wakeup.clear()
+
+            try:
+                success, msg = self.flush()
+            except Exception as e:
+                success, msg = False, str(e)
+
+            if success:
+                failures = 0
+            else:
+                failures += 1
+                print(f"寫入佇列{msg}")
+                # 失敗時等待時間加倍，避免 API 配額用盡時持續重試
+                time.sleep(min(self.flush_interval * (2 ** failures), self.max_backoff))
+
+    def start(self):
+        """啟動背景同步執行緒（重複呼叫不會建立多個執行緒）"""
+        if self._worker is None or not self._worker.is_alive():
+            self._stop = False
+            self._worker = threading.Thread(target=self._run, name="write-behind-queue", daemon=True)
+            self._worker.start()
+            self._wakeup.set()
+
+    def stop(self):
+        self._stop = True
+        self._wakeup.set()
@@ -0,0 +1,314 @@
+import os
+import sys
+import tempfile
+import threading
+import pandas as pd
+from unittest.mock import MagicMock
+
+# Mock streamlit and gsheets before importing mod（測試使用本地 SQLite 後端，不連線試算表）
+sys.modules["streamlit"] = MagicMock()
+sys.modules["streamlit_gsheets"] = MagicMock()
+sys.modules["mod.O_connect_to_gsheet"] = MagicMock()
+
+# Assuming running from 'code' directory.
+sys.path.append(".")
+from mod import O_config as config
+config.LOCAL_MIRROR = False
+
+from mod import A_add_member
+from mod import C_consume
+from mod import F_refund
+from mod import D_main_table as mt
+from mod import O_cache as cache
+from mod import O_checkpoint as ckpt
+from mod import O_general as gr
+from mod import O_storage as storage
+from mod import O_transaction as txn
+from mod import O_write_queue as wq
+from mod.O_config import COACH, EVENT_SHEET, MAIN_SHEET, MEMBER_SHEET
+
+MEMBERS = pd.DataFrame({
+    "會員編號": ["101", "102"], "會員姓名": ["王小明", "陳小華"], "生日": ["1990-01-01", "1991-02-02"],
+    "電話": ["0912345678", "0912345679"], "教練": ["100", "100"], "加入日期": ["2024-01-01", "2024-01-01"],
+    "加入時間": ["10:00:00", "10:00:00"], "備註": ["", ""],
+})
+COACHES = pd.DataFrame({"教練編號": ["100"], "姓名": ["教練A"], "會員編號": ["1"]})
+
+
+def event_row(member_id, count, total, date="2024-01-01", time="10:00:00", payment="現金"):
+    name = MEMBERS.set_index("會員編號").loc[member_id, "會員姓名"]
+    return {"會員編號": member_id, "會員姓名": name, "方案": "A", "堂數": count, "單堂金額": 100,
+            "方案總金額": total, "教練": "100", "付款方式": payment, "匯款末五碼": "無",
+            "交易日期": date, "交易時間": time, "備註": ""}
+
+
+def setup_db(events):
+    """建立暫存的 SQLite 資料庫並清空各層快取，回傳後端"""
+    tmp = tempfile.mkdtemp()
+    backend = storage.SQLiteBackend(os.path.join(tmp, "db.sqlite"))
+    storage.set_backend(backend)
+    ckpt._checkpoint = ckpt.BalanceCheckpoint(os.path.join(tmp, "checkpoint.db"))
+    cache._frames.clear()
+    gr._fresh.clear()
+    storage.forget_revision()
+
+    backend.write(MEMBER_SHEET, MEMBERS)
+    backend.write(COACH, COACHES)
+    backend.write(EVENT_SHEET, pd.DataFrame(events))
+    success, msg = mt.D_update_main_data()
+    assert success, msg
+    return backend
+
+
+def balances():
+    """主表目前的 {會員編號: 剩餘堂數}，以及由交易紀錄重新彙總的結果"""
+    df_main = gr.GET_DF_FROM_DB(MAIN_SHEET, refresh=True)
+    df_sum = mt.get_sum_table(gr.GET_DF_FROM_DB(EVENT_SHEET, refresh=True))
+    return (dict(zip(df_main["會員編號"], df_main["剩餘堂數"])),
+            dict(zip(df_sum["會員編號"], df_sum["剩餘堂數"])))
+
+
+def test_append_and_update_rows():
+    print("Testing append / update_rows...")
+    backend = setup_db([event_row("101", 4, 400)])
+
+    backend.append(EVENT_SHEET, pd.DataFrame([event_row("101", -1, -100)]), expected_rows=1)
+    assert backend.row_count(EVENT_SHEET) == 2, backend.row_count(EVENT_SHEET)
+
+    # index 為資料列位置，只覆寫該列的指定欄位
+    backend.update_rows(MAIN_SHEET, pd.DataFrame({"剩餘堂數": [3]}, index=[0]), ["剩餘堂數"])
+    df_main = backend.read(MAIN_SHEET)
+    assert df_main.loc[0, "剩餘堂數"] == 3, df_main
+    assert df_main.loc[0, "會員編號"] == "101", df_main
+    assert backend.tail(EVENT_SHEET) == (2, "101"), backend.tail(EVENT_SHEET)
+    print("append / update_rows Passed!")
+
+
+def test_write_batch_rollback():
+    print("\nTesting write_batch rollback...")
+    backend = setup_db([event_row("101", 4, 400)])
+
+    # 第二項寫入失敗（欄位不存在）時，同一批的交易紀錄附加也不可留下
+    ops = [storage.WriteOp("append", EVENT_SHEET, pd.DataFrame([event_row("101", -1, -100)])),
+           storage.WriteOp("update_rows", MAIN_SHEET, pd.DataFrame({"不存在的欄位": [1]}, index=[0]))]
+    try:
+        backend.write_batch(ops)
+        raise AssertionError("write_batch should fail")
+    except AssertionError:
+        raise
+    except Exception:
+        pass
+    assert backend.row_count(EVENT_SHEET) == 1, backend.row_count(EVENT_SHEET)
+    print("write_batch rollback Passed!")
+
+
+def test_version_conflict():
+    print("\nTesting VersionConflict...")
+    backend = setup_db([event_row("101", 4, 400), event_row("102", 2, 200)])
+
+    # 列數不符
+    try:
+        gr.WRITE_BATCH([storage.WriteOp("append", EVENT_SHEET, pd.DataFrame([event_row("101", -1, -100)]),
+                                        expected_rows=1)])
+        raise AssertionError("stale row count should conflict")
+    except storage.VersionConflict as e:
+        assert e.sheet == EVENT_SHEET and e.actual_rows == 2, e
+
+    # 覆寫主表不改變列數，同一列被其他使用者更新時由內容發現
+    engine = mt.BalanceEngine(gr.GET_DF_FROM_DB(MAIN_SHEET))
+    df_new = pd.DataFrame([event_row("101", -1, -100)])
+    df_updated, df_added = mt.get_main_changes(df_new, engine)
+    backend.update_rows(MAIN_SHEET, pd.DataFrame({"剩餘堂數": [2]}, index=[0]), ["剩餘堂數"])
+    try:
+        gr.WRITE_BATCH(mt.main_write_ops(engine, df_updated, df_added))
+        raise AssertionError("stale A_main row should conflict")
+    except storage.VersionConflict as e:
+        assert e.sheet == MAIN_SHEET and e.changed_rows == [0], e
+    assert backend.read(MAIN_SHEET).loc[0, "剩餘堂數"] == 2
+    print("VersionConflict Passed!")
+
+
+def test_coordinator_stock_recheck():
+    print("\nTesting coordinator stock re-check...")
+    setup_db([event_row("101", 1, 100)])
+    df_event = gr.GET_DF_FROM_DB(EVENT_SHEET)
+    df_member = gr.GET_DF_FROM_DB(MEMBER_SHEET)
+    success, msg, data = C_consume.validate_consume_record(["101"], "A", "教練A", df_event=df_event,
+                                                           df_member=df_member, df_coach=COACHES)
+    assert success, msg
+
+    # 兩個櫃台同時為只剩 1 堂的會員扣堂，只能有一筆成功
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(
+        C_consume.execute_consume_record(data, df_event=df_event, df_member=df_member))) for _ in range(2)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+
+    assert sorted(success for success, _ in results) == [False, True], results
+    main, expected = balances()
+    assert main["101"] == 0 and main == expected, (main, expected)
+    print("coordinator stock re-check Passed!")
+
+
+def test_event_conflict_rereads_main():
+    print("\nTesting retry after B_event conflict re-reads A_main...")
+    backend = setup_db([event_row("101", 4, 400)])
+    df_event = gr.GET_DF_FROM_DB(EVENT_SHEET)
+    df_member = gr.GET_DF_FROM_DB(MEMBER_SHEET)
+    # 本程序快取中的交易紀錄與主表
+    cache.publish(EVENT_SHEET, df_event, verify=False)
+    cache.publish(MAIN_SHEET, gr.GET_DF_FROM_DB(MAIN_SHEET), verify=False)
+
+    # 其他程序同時扣了一堂：交易紀錄多一列，主表同一列被覆寫（列數不變）
+    df_other = pd.DataFrame([event_row("101", -1, -100, time="10:05:00", payment="上課")])
+    df_main = backend.read(MAIN_SHEET)
+    df_updated, df_added = mt.get_main_changes(df_other, mt.BalanceEngine(gr.convert_column_types(df_main, MAIN_SHEET)))
+    backend.write_batch([storage.WriteOp("append", EVENT_SHEET, gr.format_for_write(df_other, EVENT_SHEET)),
+                         storage.WriteOp("update_rows", MAIN_SHEET, gr.format_for_write(df_updated, MAIN_SHEET))])
+    storage.forget_revision()
+
+    success, msg, data = C_consume.validate_consume_record(["101"], "A", "教練A", df_event=df_event,
+                                                           df_member=df_member, df_coach=COACHES)
+    assert success, msg
+    success, msg = C_consume.execute_consume_record(data, df_event=df_event, df_member=df_member)
+    assert success, msg
+
+    # 重試時若沿用舊的主表，結餘會是 3 而非 2
+    main, expected = balances()
+    assert main["101"] == 2 and main == expected, (main, expected)
+    print("B_event conflict retry Passed!")
+
+
+def test_main_engine_reused():
+    print("\nTesting A_main balance engine reuse across transactions...")
+    backend = setup_db([event_row("101", 4, 400)])
+    cache.publish(MAIN_SHEET, gr.GET_DF_FROM_DB(MAIN_SHEET), verify=False)
+    coordinator = txn.get_coordinator()
+
+    # 既有會員方案扣堂、新會員方案購買，再扣一次剛新增的方案
+    built = []
+    init = mt.BalanceEngine.__init__
+    mt.BalanceEngine.__init__ = lambda self, df_main: (built.append(len(df_main)), init(self, df_main))[1]
+    try:
+        for row in [event_row("101", -1, -100, time="10:01:00", payment="上課"),
+                    {**event_row("102", 5, 500, time="10:02:00"), "方案": "B"},
+                    {**event_row("102", -2, -200, time="10:03:00", payment="上課"), "方案": "B"}]:
+            success, msg, _ = coordinator.submit_events(pd.DataFrame([row]), df_member=MEMBERS)
+            assert success, msg
+    finally:
+        mt.BalanceEngine.__init__ = init
+    # 只在第一筆交易時由主表建立一次，之後的交易沿用同一個引擎
+    assert built == [1], built
+
+    df_cached = cache.get_published(MAIN_SHEET, cache.get_version(MAIN_SHEET))
+    df_remote = gr.convert_column_types(backend.read(MAIN_SHEET), MAIN_SHEET)
+    cols = ["會員編號", "方案", "剩餘堂數", "剩餘預收款項"]
+    assert df_cached[cols].values.tolist() == df_remote[cols].values.tolist(), (df_cached, df_remote)
+    assert df_cached[cols].values.tolist() == [["101", "A", 3, 300.0], ["102", "B", 3, 300.0]], df_cached
+    main, expected = balances()
+    assert main == expected, (main, expected)
+    print("A_main balance engine reuse Passed!")
+
+
+def test_queue_double_consume():
+    print("\nTesting write-behind queue re-validation...")
+    setup_db([event_row("101", 1, 100)])
+    df_event = gr.GET_DF_FROM_DB(EVENT_SHEET)
+    df_member = gr.GET_DF_FROM_DB(MEMBER_SHEET)
+    success, msg, data = C_consume.validate_consume_record(["101"], "A", "教練A", df_event=df_event,
+                                                           df_member=df_member, df_coach=COACHES)
+    assert success, msg
+
+    # 兩筆排隊中的扣堂（同步前都通過了送出時的檢查）
+    queue = wq.WriteBehindQueue(os.path.join(tempfile.mkdtemp(), "queue.db"))
+    assert queue.submit("consume", data)[0] and queue.submit("consume", data)[0]
+    success, msg = queue.flush()
+    assert success, msg
+
+    assert queue.pending_count() == 0
+    rejected = queue.rejected_items()
+    assert len(rejected) == 1 and "剩餘堂數不足" in rejected[0]["error"], rejected
+    main, expected = balances()
+    assert main["101"] == 0 and main == expected, (main, expected)
+
+    queue.dismiss_rejected([item["id"] for item in rejected])
+    assert queue.rejected_items() == []
+    print("write-behind queue re-validation Passed!")
+
+
+def test_queue_refund_read_failure():
+    print("\nTesting queued refund stays pending when the stock read fails...")
+    setup_db([event_row("101", 2, 200)])
+    success, msg, data = F_refund.validate_refund("101", "A", "教練A", df_event=gr.GET_DF_FROM_DB(EVENT_SHEET),
+                                                  df_member=gr.GET_DF_FROM_DB(MEMBER_SHEET), df_coach=COACHES)
+    assert success, msg
+
+    queue = wq.WriteBehindQueue(os.path.join(tempfile.mkdtemp(), "queue.db"))
+    assert queue.submit("refund", data)[0]
+
+    # 讀取失敗不是資料不成立，項目要留在佇列中等待下次同步
+    get_df_main = mt.get_df_main
+    mt.get_df_main = MagicMock(side_effect=ConnectionError("quota exceeded"))
+    try:
+        success, msg = queue.flush()
+    finally:
+        mt.get_df_main = get_df_main
+    assert not success and "quota exceeded" in msg, msg
+    assert queue.pending_count() == 1 and queue.rejected_items() == []
+
+    success, msg = queue.flush()
+    assert success, msg
+    main, expected = balances()
+    assert main["101"] == 0 and main == expected, (main, expected)
+    print("queued refund read failure Passed!")
+
+
+def test_checkpoint_detects_edited_rows():
+    print("\nTesting checkpoint invalidation after editing B_event directly...")
+    # 手動更新建立涵蓋 3 筆交易紀錄的檢查點
+    backend = setup_db([event_row("101", 4, 400), event_row("102", 2, 200), event_row("101", -1, -100)])
+
+    # 直接在試算表修改中間一列（不是最後一列）的堂數
+    backend.update_rows(EVENT_SHEET, pd.DataFrame({"堂數": [5], "方案總金額": [500]}, index=[1]), ["堂數", "方案總金額"])
+    df_event = gr.GET_DF_FROM_DB(EVENT_SHEET, refresh=True)
+
+    df_sum = mt.get_current_sum_table(df_event)
+    expected = mt.get_sum_table(df_event)
+    assert dict(zip(df_sum["會員編號"], df_sum["剩餘堂數"])) == {"101": 3, "102": 5}, df_sum
+    assert dict(zip(df_sum["會員編號"], df_sum["剩餘堂數"])) == dict(zip(expected["會員編號"], expected["剩餘堂數"]))
+    print("checkpoint invalidation Passed!")
+
+
+def test_add_member_patches_latest():
+    print("\nTesting back-to-back member adds from stale sessions...")
+    setup_db([event_row("101", 1, 100)])
+    # 兩個使用者的畫面都是新增前讀取的會員表
+    df_member = gr.GET_DF_FROM_DB(MEMBER_SHEET)
+    cache.publish(MEMBER_SHEET, df_member, verify=False)
+
+    for member_id in ["103", "104"]:
+        data = {**MEMBERS.iloc[0].to_dict(), "會員編號": member_id}
+        success, msg = A_add_member.execute_add_member(data, df_member=df_member)
+        assert success, msg
+
+    df_latest = cache.get_published(MEMBER_SHEET, cache.get_version(MEMBER_SHEET))
+    assert df_latest["會員編號"].tolist() == ["101", "102", "103", "104"], df_latest["會員編號"].tolist()
+    print("back-to-back member adds Passed!")
+
+
+if __name__ == "__main__":
+    try:
+        test_append_and_update_rows()
+        test_write_batch_rollback()
+        test_version_conflict()
+        test_coordinator_stock_recheck()
+        test_event_conflict_rereads_main()
+        test_main_engine_reused()
+        test_queue_double_consume()
+        test_queue_refund_read_failure()
+        test_checkpoint_detects_edited_rows()
+        test_add_member_patches_latest()
+        print("\nALL VERIFICATIONS PASSED")
+    except Exception as e:
+        print(f"\nVERIFICATION FAILED: {e!r}")
+        exit(1)
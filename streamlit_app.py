@@ -1,49 +1,128 @@
+import time
+_import_start = time.perf_counter()
+
 import sys
 import os
 
 # Add 'code' directory to sys.path to allow importing 'mod'
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'code'))
 
-from datetime import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+from functools import partial
+from typing import TYPE_CHECKING
 import pandas as pd
 import streamlit as st
-from mod import G_birthday as bt
-from mod.O_config import MAIN_SHEET, MEMBER_SHEET, EVENT_SHEET, COACH, MENU, ADMIN_PASSWORD
-from mod import O_general as gr
-
-from mod import F_refund
-from mod import E_customized_course
-from mod import D_main_table
-from mod import C_consume
-from mod import B_purchase
-from mod import A_add_member
-
-
-@st.cache_data(show_spinner=False)
-def load_all_data():
-    df_member = gr.GET_DF_FROM_DB(MEMBER_SHEET)
-    df_event = gr.GET_DF_FROM_DB(EVENT_SHEET)
-    df_coach = gr.GET_DF_FROM_DB(COACH)
-    df_menu = gr.GET_DF_FROM_DB(MENU)
-    df_main = gr.GET_DF_FROM_DB(MAIN_SHEET)
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from mod import O_cache as cache
+from mod.O_config import MAIN_SHEET, MEMBER_SHEET, EVENT_SHEET, COACH, MENU, ADMIN_PASSWORD, WRITE_BEHIND, WRITE_QUEUE_DATABASE
+from mod.O_lookup import LookupSnapshot, MemberIndex
+from mod import O_mirror as mirror
+from mod import O_startup as startup
+
+if TYPE_CHECKING:
+    from mod import G_birthday as bt
+
+# 各頁面的功能模組（A~G、寫入協調器、封存等）在第一次使用時才匯入，試算表連線也在第一次讀寫時才建立
+startup.record("import", time.perf_counter() - _import_start)
+
+
+def load_sheet(sheet: str, version: int) -> pd.DataFrame:
+    # 每個分頁只保留最新版本的一份資料（O_cache），version 改變（分頁被寫入）時才重新讀取
+    # 寫入流程已提供該版本的最新資料時直接使用，不需重新下載
+    # 本程序尚未異動過的分頁（例如剛啟動時）在資料庫未變動時可直接使用本地鏡像
+    return cache.get_sheet(sheet, version, partial(mirror.read_sheet, sheet, use_mirror=version == 0))
+
+
+@st.cache_resource(show_spinner=False, max_entries=5)
+def load_lookup(member_version: int, coach_version: int, menu_version: int = None) -> LookupSnapshot:
+    # 每個資料版本只建立一次查詢索引，供表單驗證使用；未讀取價目表的頁面（例如新增會員）不傳入 menu_version
+    return LookupSnapshot(
+        df_member=load_sheet(MEMBER_SHEET, member_version),
+        df_coach=load_sheet(COACH, coach_version),
+        df_menu=load_sheet(MENU, menu_version) if menu_version is not None else None)
+
+
+@st.cache_resource(show_spinner=False, max_entries=5)
+def load_member_index(member_version: int) -> MemberIndex:
+    # 會員選單與搜尋索引，每個會員表版本只建立一次
+    return MemberIndex(load_sheet(MEMBER_SHEET, member_version))
+
+
+@st.cache_resource(show_spinner=False, max_entries=5)
+def load_birthday_index(member_version: int) -> "bt.BirthdayIndex":
+    # 會員生日依月、日分組的索引，每個會員表版本只建立一次
+    from mod import G_birthday as bt
+    return bt.BirthdayIndex(load_sheet(MEMBER_SHEET, member_version))
+
+
+def get_coach_list(df_c: pd.DataFrame) -> list[str]:
+    return df_c["姓名"].tolist()
+
+
+def get_plan_list(df_m: pd.DataFrame) -> list[str]:
+    return df_m["name"].unique().tolist()
+
+
+# 以下衍生資料皆以分頁版本號（整數）作為快取 key，不需每次重新執行都雜湊整張 DataFrame
+@st.cache_resource(show_spinner=False, max_entries=10)
+def load_birthday_list(member_version: int, main_version: int, month: int) -> pd.DataFrame:
+    from mod import G_birthday as bt
+    return bt.get_birthday_member(month, df_main=load_sheet(MAIN_SHEET, main_version),
+                                  index=load_birthday_index(member_version))
+
+
+@st.cache_resource(show_spinner=False, max_entries=10)
+def load_upcoming_birthday_list(member_version: int, main_version: int, days: int, today: date) -> pd.DataFrame:
+    from mod import G_birthday as bt
+    return bt.get_upcoming_birthday_member(days, df_main=load_sheet(MAIN_SHEET, main_version),
+                                           index=load_birthday_index(member_version), today=today)
+
+
+@st.cache_resource(show_spinner=False, max_entries=5)
+def load_main_total(main_version: int) -> float:
+    # 主表的剩餘預收款項總額
+    df = load_sheet(MAIN_SHEET, main_version)
+    return float(df["剩餘預收款項"].sum()) if "剩餘預收款項" in df.columns else None
+
+
+@st.cache_resource(show_spinner=False, max_entries=5)
+def load_option_lists(coach_version: int, menu_version: int = None) -> dict:
+    # 表單下拉選單的選項（教練、方案），各使用者共用，不可直接修改；未讀取價目表時沒有方案選項
+    plan_list = get_plan_list(load_sheet(MENU, menu_version)) if menu_version is not None else []
     return {
-        "member": df_member,
-        "event": df_event,
-        "coach": df_coach,
-        "menu": df_menu,
-        "main": df_main
+        "coach": get_coach_list(load_sheet(COACH, coach_version)),
+        "plan": plan_list,
+        "consume": plan_list + ["特殊課程"]
     }
 
-# Load data once
-with st.status("正在讀取資料庫...", expanded=True) as status:
-    data_snapshot = load_all_data()
-    status.update(label="資料讀取完成！", state="complete", expanded=False)
 
-df_member = data_snapshot["member"]
-df_event = data_snapshot["event"]
-df_coach = data_snapshot["coach"]
-df_menu = data_snapshot["menu"]
-df_main = data_snapshot["main"]
+def load_page_data(sheets: list[str]) -> tuple[dict, dict]:
+    # 只讀取目前頁面需要的分頁：已快取的分頁立即回傳，需重新讀取的分頁並行下載
+    # 一次取得所有分頁的版本號，同一次執行中使用的資料屬於同一組版本
+    versions = cache.get_versions()
+    if not sheets:
+        return versions, {}
+    ctx = get_script_run_ctx()
+
+    def attach_ctx():
+        add_script_run_ctx(threading.current_thread(), ctx)
+
+    with ThreadPoolExecutor(max_workers=len(sheets), initializer=attach_ctx) as executor:
+        futures = {sheet: executor.submit(load_sheet, sheet, versions[sheet]) for sheet in sheets}
+        page_data = {sheet: future.result() for sheet, future in futures.items()}
+
+    return versions, page_data
+
+
+@st.cache_resource
+def get_write_queue():
+    # 整個程序共用一個寫入佇列與背景同步執行緒
+    from mod.O_write_queue import WriteBehindQueue
+    queue = WriteBehindQueue(os.path.join(os.path.dirname(__file__), WRITE_QUEUE_DATABASE))
+    queue.start()
+    return queue
 
 
 st.set_page_config(page_title="健身訓練會員系統", layout="wide")
@@ -87,6 +166,70 @@ if st.sidebar.button("🔄 手動更新", use_container_width=True):
 
 page = st.session_state.page
 
+if WRITE_BEHIND:
+    write_queue = get_write_queue()
+    pending = write_queue.pending_count()
+    if pending:
+        st.sidebar.caption(f"⏳ 尚有 {pending} 筆資料等待同步")
+
+    # 同步時重新檢查已不成立（例如剩餘堂數已不足）的項目未寫入資料庫，需告知使用者
+    rejected_items = write_queue.rejected_items()
+    if rejected_items:
+        with st.sidebar.expander(f"⚠️ {len(rejected_items)} 筆資料未寫入", expanded=True):
+            for item in rejected_items:
+                names = "、".join(str(record.get("會員姓名", record.get("會員編號", ""))) for record in item["records"])
+                st.error(f"{item['created_at']} {names}\n\n{item['error']}")
+            if st.button("已確認，清除提示", use_container_width=True):
+                write_queue.dismiss_rejected([item["id"] for item in rejected_items])
+                st.rerun()
+
+
+# 各頁面需要的分頁，只讀取目前頁面用到的資料（例如新增會員不需讀取交易紀錄與主表）
+PAGE_SHEETS = {
+    "首頁": [],
+    "新增會員": [MEMBER_SHEET, COACH],
+    "購買課程": [MEMBER_SHEET, COACH, MENU],
+    "會員上課": [MEMBER_SHEET, EVENT_SHEET, COACH, MENU],
+    "會員退款": [MEMBER_SHEET, EVENT_SHEET, COACH, MENU],
+    "當月壽星": [MEMBER_SHEET, MAIN_SHEET],
+    "手動更新": [],
+}
+# 管理員在這些頁面會看到會員總覽，需要另外讀取主表
+MAIN_TABLE_PAGES = {"首頁", "購買課程", "會員上課", "會員退款"}
+
+page_sheets = list(PAGE_SHEETS.get(page, []))
+if st.session_state.is_admin and page in MAIN_TABLE_PAGES:
+    page_sheets.append(MAIN_SHEET)
+# 確認視窗尚未關閉時（例如確認中切換到其他頁面）仍需教練表顯示教練姓名
+if st.session_state.get("confirm_data") is not None and COACH not in page_sheets:
+    page_sheets.append(COACH)
+
+if page_sheets:
+    with st.status("正在讀取資料庫...", expanded=True) as status:
+        with startup.measure("first_load"):
+            versions, page_data = load_page_data(page_sheets)
+        status.update(label="資料讀取完成！", state="complete", expanded=False)
+    # 程序啟動後第一次讀取資料時，輸出匯入、連線與讀取各階段的耗時
+    startup.report()
+else:
+    versions, page_data = load_page_data(page_sheets)
+
+# 目前頁面未使用的分頁為 None
+df_member = page_data.get(MEMBER_SHEET)
+df_event = page_data.get(EVENT_SHEET)
+df_coach = page_data.get(COACH)
+df_menu = page_data.get(MENU)
+df_main = page_data.get(MAIN_SHEET)
+has_forms = {MEMBER_SHEET, COACH}.issubset(page_data)
+menu_version = versions[MENU] if df_menu is not None else None
+lookup = load_lookup(versions[MEMBER_SHEET], versions[COACH], menu_version) if has_forms else None
+
+
+# 日期欄位以日期型別讀取，顯示時只顯示年月日
+DATE_COLUMN_CONFIG = {
+    col: st.column_config.DateColumn(format="YYYY-MM-DD") for col in ["最近交易日期", "加入日期", "交易日期"]
+}
+
 
 def show_main_table(show_total=False, df_main_data=None):
     if not st.session_state.is_admin:
@@ -97,56 +240,58 @@ def show_main_table(show_total=False, df_main_data=None):
         df = df_main_data if df_main_data is not None else df_main
 
         if show_total and "剩餘預收款項" in df.columns:
-            total_remaining = df["剩餘預收款項"].sum()
+            # 目前版本的主表使用快取的總額
+            total_remaining = load_main_total(versions[MAIN_SHEET]) if df is df_main else df["剩餘預收款項"].sum()
             st.subheader(f"剩餘預收款項總額：{int(total_remaining):,} 元")
 
         st.subheader("會員總覽")
-        st.dataframe(df, use_container_width=True)
+        st.dataframe(df, use_container_width=True, column_config=DATE_COLUMN_CONFIG)
     except Exception as e:
         st.error(f"讀取資料失敗: {e}")
 
 
-def get_coach_list(df_c: pd.DataFrame) -> list[str]:
-    return df_c["姓名"].tolist()
-
-
-coach_list = get_coach_list(df_coach)
-
-
-def get_plan_list(df_m: pd.DataFrame) -> list[str]:
-    return df_m["name"].unique().tolist()
-
-
-plan_list = get_plan_list(df_menu)
-consume_list = plan_list.copy()
-consume_list.append("特殊課程")
+option_lists = load_option_lists(versions[COACH], menu_version) if has_forms else {}
+coach_list = option_lists.get("coach", [])
+plan_list = option_lists.get("plan", [])
+consume_list = option_lists.get("consume", [])
 
 # --- Helper Functions for Confirmation ---
 
 
 def get_execute_func(action_type):
+    if WRITE_BEHIND:
+        queue = get_write_queue()
+        return lambda data: queue.submit(action_type, data)
+
+    # 傳入目前快取中的資料，寫入成功後直接併入新資料，不需重新讀取
     if action_type == "add_member":
-        return A_add_member.execute_add_member
+        from mod import A_add_member
+        return partial(A_add_member.execute_add_member, df_member=df_member)
     elif action_type == "purchase":
-        return B_purchase.execute_purchase_record
+        from mod import B_purchase
+        return partial(B_purchase.execute_purchase_record, df_event=df_event, df_member=df_member)
     elif action_type == "customized_purchase":
-        return E_customized_course.execute_customized_course_record
+        from mod import E_customized_course
+        return partial(E_customized_course.execute_customized_course_record, df_event=df_event, df_member=df_member)
     elif action_type == "consume":
-        return C_consume.execute_consume_record
+        from mod import C_consume
+        return partial(C_consume.execute_consume_record, df_event=df_event, df_member=df_member)
     elif action_type == "refund":
-        return F_refund.execute_refund
+        from mod import F_refund
+        return partial(F_refund.execute_refund, df_event=df_event, df_member=df_member)
     return None
 
 
-def get_member_selection_list(df_m: pd.DataFrame) -> list[str]:
-    try:
-        # Format: "會員編號 - 會員姓名"
-        return [f"{row['會員編號']} - {row['會員姓名']}" for _, row in df_m.iterrows()]
-    except Exception:
-        return []
+def get_member_index() -> MemberIndex:
+    # 只有需要選擇會員的頁面才建立會員選單索引
+    return load_member_index(versions[MEMBER_SHEET])
 
 
-member_selection_list = get_member_selection_list(df_member)
+def get_member_options(search_key: str, select_key: str) -> list[str]:
+    # 選項為會員編號（顯示為「會員編號 - 會員姓名」），可依會員編號、姓名或電話篩選
+    # 已選取的會員一律保留在選項中，篩選條件改變時不會被取消選取
+    query = st.text_input("搜尋會員", placeholder="輸入會員編號、姓名或電話篩選", key=search_key)
+    return get_member_index().search(query, keep=st.session_state.get(select_key))
 
 
 @st.dialog("資料確認")
@@ -170,7 +315,7 @@ def run_confirmation_dialog():
             
             # Find coach name using cached df_coach
             c_name = "未知"
-            if '教練' in first:
+            if '教練' in first and df_coach is not None:
                c_row = df_coach[df_coach['教練編號'] == first['教練']]
                if not c_row.empty:
                    c_name = c_row['姓名'].iloc[0]
@@ -212,15 +357,15 @@ def run_confirmation_dialog():
                 if action == "add_member":
                     keys_to_clear = ["add_m_id", "add_m_phone", "add_m_coach", "add_m_name", "add_m_birthday", "add_m_remarks"]
                 elif action == "purchase":
-                     keys_to_clear = ["purchase_normal_member", "purchase_normal_plan", "purchase_normal_payment", "purchase_normal_coach", 
+                     keys_to_clear = ["purchase_normal_search", "purchase_normal_member", "purchase_normal_plan", "purchase_normal_payment", "purchase_normal_coach", 
                                       "purchase_normal_count", "purchase_normal_account", "purchase_normal_remarks"]
                 elif action == "customized_purchase":
-                     keys_to_clear = ["purchase_custom_member", "purchase_custom_count", "purchase_custom_payment", "purchase_custom_coach",
+                     keys_to_clear = ["purchase_custom_search", "purchase_custom_member", "purchase_custom_count", "purchase_custom_payment", "purchase_custom_coach",
                                       "purchase_custom_price", "purchase_custom_account", "purchase_custom_remarks"]
                 elif action == "consume":
-                     keys_to_clear = ["consume_members", "consume_coach", "consume_plan", "consume_remarks"]
+                     keys_to_clear = ["consume_search", "consume_members", "consume_coach", "consume_plan", "consume_remarks"]
                 elif action == "refund":
-                     keys_to_clear = ["refund_members", "refund_coach", "refund_plan", "refund_remarks"]
+                     keys_to_clear = ["refund_search", "refund_members", "refund_coach", "refund_plan", "refund_remarks"]
                 
                 for k in keys_to_clear:
                     if k in st.session_state:
@@ -229,8 +374,6 @@ def run_confirmation_dialog():
                 # Clear confirmation state
                 del st.session_state.confirm_data
                 del st.session_state.confirm_action
-                # Clear cache and rerun
-                st.cache_data.clear()
                 st.rerun()
             else:
                 st.error(msg)
@@ -243,14 +386,6 @@ def run_confirmation_dialog():
         st.rerun()
 
 
-@st.cache_data
-def load_birthday_data(df_evt, df_mem):
-    return bt.get_birthday_member(df_event=df_evt, df_member=df_mem)
-
-
-df_birthday = load_birthday_data(df_event, df_member)
-
-
 # Manage Dialog State
 if "confirm_data" in st.session_state and st.session_state.confirm_data is not None:
     run_confirmation_dialog()
@@ -280,6 +415,7 @@ if page == "首頁":
 
 # --- Page: 新增會員 ---
 elif page == "新增會員":
+    from mod import A_add_member
     st.title("👤 新增會員")
 
     min_date = datetime(1900, 1, 1)
@@ -310,7 +446,7 @@ elif page == "新增會員":
 
             # Validation
             success, msg, data = A_add_member.validate_add_member(
-                member_id, name, birthday_str, phone, coach, remarks, df_member=df_member, df_coach=df_coach)
+                member_id, name, birthday_str, phone, coach, remarks, df_member=df_member, df_coach=df_coach, lookup=lookup)
 
             if success:
                 st.session_state.confirm_data = data
@@ -323,7 +459,7 @@ elif page == "新增會員":
     st.subheader("會員列表")
     if st.session_state.is_admin:
         try:
-            st.dataframe(df_member, use_container_width=True)
+            st.dataframe(df_member, use_container_width=True, column_config=DATE_COLUMN_CONFIG)
         except Exception as e:
             st.error(f"讀取會員表失敗: {e}")
     else:
@@ -331,6 +467,8 @@ elif page == "新增會員":
 
 # --- Page: 購買課程 ---
 elif page == "購買課程":
+    from mod import B_purchase
+    from mod import E_customized_course
     st.title("💰 購買課程")
 
     st.markdown("""
@@ -360,12 +498,14 @@ elif page == "購買課程":
     tab1, tab2 = st.tabs(["一般課程", "特殊課程"])
 
     with tab1:
+        member_options = get_member_options("purchase_normal_search", "purchase_normal_member")
         with st.form("purchase_form"):
             col1, col2 = st.columns(2)
             with col1:
                 selected_members_normal = st.multiselect(
                     "選擇會員 (單選)",
-                    member_selection_list,
+                    member_options,
+                    format_func=get_member_index().label,
                     placeholder='請選擇會員',
                     max_selections=1,
                     key="purchase_normal_member"
@@ -390,16 +530,11 @@ elif page == "購買課程":
             submitted = st.form_submit_button("確認送出")
 
             if submitted:
-                member_id = ""
-                if selected_members_normal:
-                    try:
-                        member_id = selected_members_normal[0].split(" - ")[0]
-                    except:
-                        pass
+                member_id = selected_members_normal[0] if selected_members_normal else ""
 
                 success, msg, data = B_purchase.validate_purchase_record(
                     member_id, plan, count_selection, payment, coach, account_id, remarks,
-                    df_member=df_member, df_menu=df_menu, df_coach=df_coach
+                    df_member=df_member, df_menu=df_menu, df_coach=df_coach, lookup=lookup
                 )
 
                 if success:
@@ -410,12 +545,14 @@ elif page == "購買課程":
                     st.error(msg)
 
     with tab2:
+        member_options = get_member_options("purchase_custom_search", "purchase_custom_member")
         with st.form("customized_purchase_form"):
             col1, col2 = st.columns(2)
             with col1:
                 selected_members_custom = st.multiselect(
                     "選擇會員 (單選)",
-                    member_selection_list,
+                    member_options,
+                    format_func=get_member_index().label,
                     placeholder='請選擇會員',
                     max_selections=1,
                     key="purchase_custom_member"
@@ -441,16 +578,11 @@ elif page == "購買課程":
             submitted = st.form_submit_button("確認送出")
 
             if submitted:
-                member_id = ""
-                if selected_members_custom:
-                    try:
-                        member_id = selected_members_custom[0].split(" - ")[0]
-                    except:
-                        pass
+                member_id = selected_members_custom[0] if selected_members_custom else ""
 
                 success, msg, data = E_customized_course.validate_customized_course_record(
                     member_id, count_selection, price, payment, coach, account_id, remarks,
-                    df_member=df_member, df_coach=df_coach
+                    df_member=df_member, df_coach=df_coach, lookup=lookup
                 )
 
                 if success:
@@ -465,15 +597,17 @@ elif page == "購買課程":
 
 # --- Page: 會員上課 ---
 elif page == "會員上課":
+    from mod import C_consume
     st.title("🏋️ 會員上課 (扣堂)")
 
+    member_options = get_member_options("consume_search", "consume_members")
     with st.form("consume_form"):
         col1, col2 = st.columns(2)
         with col1:
-            # Replace text_input with multiselect
             selected_members = st.multiselect(
                 "選擇會員 (可多選)",
-                member_selection_list,
+                member_options,
+                format_func=get_member_index().label,
                 placeholder='請搜尋並選擇會員',
                 key="consume_members"
             )
@@ -493,19 +627,11 @@ elif page == "會員上課":
         submitted = st.form_submit_button("確認送出")
 
         if submitted:
-            # Extract Member IDs
-            # Format is "{id} - {name}", split by " - " and take first part
-            member_ids = []
-            if selected_members:
-                for item in selected_members:
-                    try:
-                        mid = item.split(" - ")[0]
-                        member_ids.append(mid)
-                    except:
-                        pass
+            # 選項即為會員編號
+            member_ids = list(selected_members)
 
             success, msg, data = C_consume.validate_consume_record(
-                member_ids, plan, coach, remarks, df_event=df_event, df_member=df_member, df_coach=df_coach)
+                member_ids, plan, coach, remarks, df_event=df_event, df_member=df_member, df_coach=df_coach, lookup=lookup)
 
             if success:
                 st.session_state.confirm_data = data
@@ -519,15 +645,18 @@ elif page == "會員上課":
 
 # --- Page: 會員退款 ---
 elif page == "會員退款":
+    from mod import F_refund
     st.title("💸 會員退款")
     st.info("⚠️ 注意：此功能將會把該會員指定方案的「剩餘堂數」與「剩餘預收款項」全部扣除（歸零）。")
 
+    member_options = get_member_options("refund_search", "refund_members")
     with st.form("refund_form"):
         col1, col2 = st.columns(2)
         with col1:
             selected_members = st.multiselect(
                 "選擇會員 (單選)",
-                member_selection_list,
+                member_options,
+                format_func=get_member_index().label,
                 placeholder='請選擇一位會員',
                 max_selections=1,
                 key="refund_members"
@@ -551,16 +680,13 @@ elif page == "會員退款":
             member_id = ""
             if selected_members:
                 # 雖然限制 max_selections=1，但回傳仍是 list
-                try:
-                    member_id = selected_members[0].split(" - ")[0]
-                except:
-                    pass
+                member_id = selected_members[0]
             else:
                 st.error("請選擇一位會員")
 
             if member_id:
                 success, msg, data = F_refund.validate_refund(
-                    member_id, plan, coach, remarks, df_event=df_event, df_member=df_member, df_coach=df_coach)
+                    member_id, plan, coach, remarks, df_event=df_event, df_member=df_member, df_coach=df_coach, lookup=lookup)
 
                 if success:
                     st.session_state.confirm_data = data
@@ -576,17 +702,32 @@ elif page == "會員退款":
 elif page == "當月壽星":
     st.title("🎂 當月壽星")
     st.subheader(f"本月 ({datetime.now().month}月) 壽星名單")
-    st.dataframe(df_birthday, use_container_width=True)
+    # 只取出壽星在主表中的結餘，不需重新彙總交易紀錄；會員表與主表未變動時直接使用快取
+    df_birthday = load_birthday_list(versions[MEMBER_SHEET], versions[MAIN_SHEET], datetime.now().month)
+    st.dataframe(df_birthday, use_container_width=True, column_config=DATE_COLUMN_CONFIG)
+
+    st.subheader("近期壽星名單")
+    upcoming_days = st.number_input("未來天數", min_value=1, max_value=60, value=7, step=1, key="birthday_days")
+    df_upcoming = load_upcoming_birthday_list(versions[MEMBER_SHEET], versions[MAIN_SHEET], int(upcoming_days),
+                                              datetime.now().date())
+    st.dataframe(df_upcoming, use_container_width=True, column_config=DATE_COLUMN_CONFIG)
 
 # --- Page: 手動更新 ---
 elif page == "手動更新":
+    from mod import D_main_table
+    from mod import O_archive
+    from mod import O_transaction
     st.title("🔄 手動更新並備份主表")
     st.info("此功能會重新計算所有交易紀錄並更新主表。")
 
+    write_checkpoint = st.checkbox("同時建立結餘檢查點", value=True,
+                                   help="之後重算結餘時只需累加檢查點之後的交易紀錄")
+
     if st.button("執行更新"):
         # Manual update reads fresh, so no arguments
         with st.status("正在更新主表...", expanded=True) as status:
-            success, msg = D_main_table.D_update_main_data()
+            success, msg = O_transaction.get_coordinator().run(
+                D_main_table.D_update_main_data, write_checkpoint=write_checkpoint)
             if success:
                 status.update(label="更新成功！", state="complete", expanded=False)
             else:
@@ -597,12 +738,31 @@ elif page == "手動更新":
 
 
 
-            st.cache_data.clear()
-            # Reload happens on rerun, but we can't rerun immediately if we want to show success msg first?
-            # Actually line 533 above does clear cache.
-            # show_main_table needs df. Since we cleared cache, we should just rerun or reload.
-            # But prompt says check correctness.
-            # Best is to rerun so everything reloads matching the new data.
+            # 手動更新可能是為了同步直接修改試算表的內容，所有分頁都重新讀取
+            cache.invalidate_action("manual_update")
             st.rerun()
         else:
             st.error(msg)
+
+    st.divider()
+    st.subheader("封存已結束年度的交易紀錄")
+    if st.session_state.is_admin:
+        st.info("指定年度以前的交易紀錄會移至各年度的封存分頁，交易紀錄表改以期初結轉列保留各會員方案的結餘，主表結果不變。")
+        cutoff_year = st.number_input("封存此年度以前（不含）的交易紀錄", min_value=2000, max_value=datetime.now().year,
+                                      value=datetime.now().year, step=1, key="archive_cutoff_year")
+
+        if st.button("執行封存"):
+            with st.status("正在封存交易紀錄...", expanded=True) as status:
+                success, msg = O_transaction.get_coordinator().run(
+                    O_archive.archive_closed_years, cutoff_year=int(cutoff_year))
+                if success:
+                    status.update(label="封存完成！", state="complete", expanded=False)
+                else:
+                    status.update(label="封存失敗", state="error", expanded=False)
+
+            if success:
+                st.success(msg)
+            else:
+                st.error(msg)
+    else:
+        st.info("請先至首頁驗證管理員身份以使用封存功能")